@@ -1,12 +1,14 @@
 from . import config 
 from . import models
 from .audience import Adapter, Sorter
-from .utils import (stream_ftp, sqlite_import, 
+from .sources import stream_source, stream_ftp, source_for, FTPSource, LocalSource
+from .utils import (sqlite_import, sqlite_merge, record_ingested,
                     write_database, sqlite_truncate)
 
 # removing duplicates in namespace
 del audience
 del utils
+del sources
 
 
 
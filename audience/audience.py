@@ -1,12 +1,57 @@
+import json
+import time
+import uuid
+import urllib.parse
+import itertools
 import pprint
+import hashlib
+import threading
 
 from . import config 
 from . import models
+from .utils import tiers
+from .throttle import (TokenBucket, BatchSizer, call_with_retry, is_throttled,
+                       is_oversized, is_retryable)
+from .metrics import metrics
+from .transport import keep_alive
 
+from peewee import fn, Query, RawQuery
 from facebookads import FacebookAdsApi
+from facebookads.api import FacebookResponse
 from facebookads.session import FacebookSession
 from facebookads.objects import (AdAccount, CustomAudience)
-from datetime import datetime, date
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Users:
+    """ A lazily read, re-iterable sequence of users. Every iteration
+    runs its queries afresh and steps through the SQLite cursor row
+    by row, so only the current row is held; plain iterables (lists)
+    are chained in as they are.
+    
+    :params sources: peewee queries selecting one column, or iterables
+    
+    return :: container.Users object
+    """
+    
+    def __init__(self, *sources):
+        self._sources = sources
+    
+    def __iter__(self):
+        for source in self._sources:
+            if isinstance(source, (Query, RawQuery)):
+                for user, in source.database.execute_sql(*source.sql()):
+                    yield user
+            else:
+                for user in source:
+                    yield user
+    
+    def __str__(self):
+        return '<[Users Object]>'
+    
+    def __repr__(self):
+        return '<Users Object [{} sources]>'.format(len(self._sources))
 
 
 class Sorter:
@@ -29,55 +74,98 @@ class Sorter:
 	add_remove_sort but not both.'
 
     :params table: str, table you want to use for data source
+    :params changes: dict, change set returned by sqlite_merge; the
+    add_remove_sort then starts from it instead of the latest file
+    :params stream: boolean, results are Users read straight from the
+    database as they are consumed instead of lists. They must be read
+    on the thread that sorted: the moves live in a TEMP table.
+
+    Segments are the recency tiers of utils.tiers, any number of them;
+    adds(segment) and removes(segment) give the users per segment and
+    the current, lapsed and extra_lapsed properties the first three.
 	
 	return :: container.Sorter object
 	"""
     
-    def __init__(self, table=None):
+    def __init__(self, table=None, changes=None, stream=False):
         try:
             self.__customers = models.__dict__[table]
         except KeyError:
             self.__customers = models.customers
         
-        self._ca, self._la, self._ela = [], [], []  # ADD user lists
-        self._cad, self._lad, self._elad = [], [], []  # DELETE user lists
+        self._changes = changes
+        self._stream = stream
+        self._adds = {segment: [] for segment in tiers.names}  # ADD users
+        self._removes = {segment: [] for segment in tiers.names}  # DELETE users
     
     def _generate_deletes(self):
-        """ This builds a list of dictionaries containing
-        the users that need to be removed and added for certain
-        audiences.
+        """ This finds the users that need to be removed and added for
+        certain audiences as their last order date ages.
         
-        There are 3 buckets based on difference of days between
-        report run time and last order date:
+        The buckets are the recency tiers of utils.tiers, by default
+        based on difference of days between report run time and last
+        order date:
 
             ::::> [0,90]
             ::::> (90,730]
             ::::> [730, inf)
         
-        We find the deletes by looking at the difference between today's date
-        and the last order date. If it falls within a certain bucket and its
-        segment does not match that bucket, we move it to the next bucket, add 
-        as delete in the current bucket and rename the record's segment. 
-        """
-        self._la, self._ela = [], []
-        self._cad, self._lad, self._elad = [], [], [] 
-        
-        today = date.today()
-        
-        for record in self.__customers.select():
-            order = datetime.strptime(record.last_order_date, '%Y-%m-%d').date()
-            if (today-order).days > 90 and (today-order).days <= 730:
-                if record.segment == 'current':
-                    self._cad.append(record.usa_email)
-                    self._la.append(record.usa_email)
-                    record.segment = 'lapsed'
-                    record.save()
-            if (today-order).days > 730:
-                if record.segment == 'lapsed':
-                    self._lad.append(record.usa_email)
-                    self._ela.append(record.usa_email)
-                    record.segment = 'extra lapsed'
-                    record.save()
+        A record whose last order date has aged past the end of its
+        segment moves to the tier its date now falls in: it is a delete
+        in its old segment and an add in the new one, and the record's
+        segment is renamed. 
+
+        Every transition comes out of one statement: one range on the
+        (segment, last_order_date) index per tier, the new tier from a
+        CASE over the cutoffs. The moves are recorded in the TEMP table
+        sort_moves (email_hash, segment moved out of, segment moved
+        into) and the records renamed with one UPDATE, all in one
+        transaction. Dates are stored as ISO strings, so string
+        comparison is date comparison.
+        
+        The moves are added to what _generate_pushes found, as lists,
+        or as Users read back lazily in stream mode.
+        """
+        table = self.__customers
+        database = table._meta.database
+        target, target_params = tiers.case('last_order_date')
+        aged, aged_params = tiers.aged('segment', 'last_order_date')
+
+        with database.atomic():
+            database.execute_sql('DROP TABLE IF EXISTS temp.sort_moves')
+            database.execute_sql('CREATE TEMP TABLE sort_moves '
+                                 '(email_hash TEXT, segment TEXT, target TEXT)')
+            database.execute_sql(
+                'INSERT INTO temp.sort_moves SELECT email_hash, segment, {} '
+                'FROM {} WHERE {}'.format(target, table._meta.db_table, aged),
+                target_params + aged_params)
+            database.execute_sql(
+                'UPDATE {} SET segment = {} WHERE {}'.format(
+                    table._meta.db_table, target, aged),
+                target_params + aged_params)
+
+        moved = ('SELECT email_hash FROM temp.sort_moves '
+                 'WHERE {} = ? AND email_hash IS NOT NULL')
+        for segment in tiers.names:
+            removes = Users(table.raw(moved.format('segment'), segment))
+            adds = Users(table.raw(moved.format('target'), segment))
+            if self._stream:
+                self._removes[segment] = Users(self._removes[segment], removes)
+                self._adds[segment] = Users(self._adds[segment], adds)
+            else:
+                self._removes[segment].extend(removes)
+                self._adds[segment].extend(adds)
+
+    def _users(self, where):
+        """ Returns the email_hash column of the records matching
+        a where clause, without building model objects.
+
+        :params where: peewee expression
+        """
+        table = self.__customers
+        query = table.select(table.email_hash).where(where).tuples()
+
+        return [email_hash for email_hash, in query]
 
     def _generate_pushes(self, initial=False):
         """ _generates_pushes builds list of dictionaries containing the users that
@@ -90,25 +178,42 @@ class Sorter:
         This is determined by the file_parse_date field in the database 
         table.
         
+        Both sorts read (segment, email_hash) and (file_parse_date, email_hash)
+        straight out of covering indexes; no model objects are built. The
+        lists hold the SHA-256 email hashes written at import.
+        
+        With a change set from sqlite_merge the continous sort reads
+        nothing: adds and removes per segment are taken as they are.
+        
         :params initial: boolean, True = initial sort; False = continous sort
         """
-        self._ca, self._la, self._ela = [], [], []
+        self._adds = {segment: [] for segment in tiers.names}
+        self._removes = {segment: [] for segment in tiers.names}
         table = self.__customers
         
-        if initial:
-            for record in table.select():
-                if record.segment == 'current':
-                    self._ca.append(record.usa_email)
-                if record.segment == 'lapsed':
-                    self._la.append(record.usa_email)
-                if record.segment == 'extra lapsed':
-                    self._ela.append(record.usa_email)
+        if not initial and self._changes is not None:
+            for segment in tiers.names:
+                self._adds[segment] = list(self._changes[segment]['add'])
+                self._removes[segment] = list(self._changes[segment]['remove'])
+        elif initial and self._stream:
+            self._adds = {segment: Users(table.select(table.email_hash)
+                                         .where(table.segment == segment))
+                          for segment in tiers.names}
+        elif initial:
+            query = (table.select(table.segment, table.email_hash)
+                     .order_by(table.segment).tuples())
+            for segment, email_hash in query:
+                if segment in self._adds:
+                    self._adds[segment].append(email_hash)
         else:
             target_field = table.file_parse_date
-            check = table.select().order_by(target_field.desc()).get()
-            print('file parse date: {}'.format(check.file_parse_date))
-            for record in table.select().where(target_field == check.file_parse_date):
-                self._ca.append(record.usa_email)
+            latest = table.select(fn.MAX(target_field)).scalar()
+            print('file parse date: {}'.format(latest))
+            if self._stream:
+                self._adds[tiers.names[0]] = Users(table.select(table.email_hash)
+                                                   .where(target_field == latest))
+            else:
+                self._adds[tiers.names[0]] = self._users(target_field == latest)
     
     @property
     def add_sort(self):
@@ -121,47 +226,43 @@ class Sorter:
         self._generate_deletes()
         return print("Add-Remove Sorting Complete.")
     
+    def adds(self, segment):
+        """ The users to add to a segment's audience.
+        
+        :params segment: str, segment name
+        """
+        return self._adds[segment]
+    
+    def removes(self, segment):
+        """ The users to remove from a segment's audience.
+        
+        :params segment: str, segment name
+        """
+        return self._removes[segment]
+    
     @property
     def current(self):
-        if hasattr(self, '_ca'):
-            return self._ca
-        else:
-        	return False
+        return self.adds(tiers.names[0])
     
     @property
     def lapsed(self):
-        if hasattr(self, '_la'):
-        	return self._la
-        else:
-        	return False
+        return self.adds(tiers.names[1])
     
     @property
     def extra_lapsed(self):
-        if hasattr(self, '_ela'):
-    	    return self._ela
-        else:
-    	    return False
+        return self.adds(tiers.names[2])
     
     @property
     def current_deletes(self):
-        if hasattr(self, '_cad'):
-    	    return self._cad
-        else:
-    	    return False
+        return self.removes(tiers.names[0])
     
     @property
     def lapsed_deletes(self):
-        if hasattr(self, '_lad'):
-    	    return self._lad
-        else:
-    	    return False
+        return self.removes(tiers.names[1])
     
     @property
     def extra_lapsed_deletes(self):
-        if hasattr(self, '_elad'):
-    	    return self._elad
-        else:
-    	    return False
+        return self.removes(tiers.names[2])
     
     def __str__(self):
         return '<[Sorter Object]>'
@@ -172,50 +273,125 @@ class Sorter:
 
 class Adapter:
     """ An object designed to make managing custom audiences a little easier.
+
+    Every user upload goes through a token bucket fed by the Graph API
+    usage headers and is retried with jittered backoff when throttled.
+    With workers > 1 the batches of an upload, across every audience in
+    it, run in parallel on a pool of threads.
+
+    Each acknowledged batch of hashed users is written to the
+    audience_members table, a local record of what every audience
+    holds. sync() uploads only the difference between that record
+    and the desired segment membership.
+
+    Every batch is journaled in the upload_journal table before it is
+    sent and marked once acknowledged, so resume() can finish an upload
+    that failed partway through.
+
+    Users per call are tuned per endpoint by a throttle.BatchSizer from
+    the latency and errors of the calls, and kept in the batch_sizes
+    table for the next run. Journaled batches are cut again to the
+    current size as they are sent, so the tuning applies within a run. A batch refused as too large is split in
+    halves and sent again.
+
+    Uploads go out as Graph API batch requests of up to
+    API_BATCH_CALLS calls over the session's keep-alive connection
+    pool; a call that fails inside a batch is sent again on its own.
     
     :params account: str, account id
     :params table: str, table name from database
+    :params workers: int, concurrent upload calls
+    :params rate: float, upload calls per second at zero API usage
+    :params cache_ttl: float, seconds before the audience listing is
+    fetched again; None keeps it for the life of the object
+    :params pre_hashed: boolean, users are already SHA-256 email hashes
+    (the Sorter lists are, and run.py says so) and are uploaded as they
+    are; False = raw emails, hashed by the SDK
+    :params settings: module, configuration holding the credentials and
+    upload options; defaults to audience.config. Every Adapter has its
+    own session, so several accounts can be served from one process.
     
     return :: container.Adapter object
     """
-    __session = FacebookSession(config.APP_ID, config.APP_SECRET,
-			 config.ACCESS_TOKEN)
-    __api = FacebookAdsApi(__session)
     
-    def __init__(self, account=None, table='customers'):
-        FacebookAdsApi.set_default_api(self.__api)
+    def __init__(self, account=None, table='customers', workers=None, rate=None,
+                 cache_ttl=None, pre_hashed=False, settings=None):
+        settings = settings or config
+        self.__session = FacebookSession(settings.APP_ID, settings.APP_SECRET,
+                                         settings.ACCESS_TOKEN)
+        self.__api = FacebookAdsApi(self.__session)
+        self._workers = workers or settings.API_WORKERS
+        keep_alive(self.__session.requests, self._workers,
+                   settings.API_GZIP_MINIMUM)
+        self._request_calls = settings.API_BATCH_CALLS
+        self._request_users = settings.API_BATCH_USERS
+        self._bucket = TokenBucket(rate or settings.API_RATE,
+                                   capacity=self._workers)
+        self._cache_ttl = cache_ttl or settings.AUDIENCE_CACHE_TTL
+        self._pre_hashed = pre_hashed
+        self.__customers = models.__dict__[table]
+        self.__members = models.audience_members
+        self.__journal = models.upload_journal
+        self.__batch_sizes = models.batch_sizes
+        self._sizer = BatchSizer(settings.BATCH_TARGET_SECONDS)
+        self._sizes_loaded = False
+        self._db_lock = threading.Lock()
+        self.invalidate()
         if account:
             self._account = 'act_{}'.format(account)
             self.__api.set_default_account_id = self._account
-            self._audiences = AdAccount(self._account).get_custom_audiences(
-                fields=[CustomAudience.Field.name, CustomAudience.Field.id])
             self._responses = []
     
+    def _audience_index(self):
+        """ This returns the cached name -> id map of the account's
+        audiences, listing them from the API only on first use, after
+        invalidate() or once the cache_ttl has run out.
+        """
+        expired = (self._cache_ttl is not None and
+                   time.monotonic() - self._listed_at > self._cache_ttl)
+        
+        if self._audience_ids is None or expired:
+            cursor = AdAccount(self._account, api=self.__api).get_custom_audiences(
+                fields=[CustomAudience.Field.name, CustomAudience.Field.id])
+            self._audience_ids = {audience['name']: audience['id']
+                                  for audience in cursor}
+            metrics.count('api_calls', action='list')
+            self._listed_at = time.monotonic()
+        
+        return self._audience_ids
+    
+    def invalidate(self):
+        """ This drops the cached audience listing.
+        """
+        self._audience_ids, self._listed_at = None, 0.0
+    
     def _get_audience(self, audience_name):
         """ This retrieves an audience object based on a string name.
         
         :params audience_name: str, name of audience
         """
-        for audience in list(self.audiences):
-            if audience['name'] == audience_name:
-                audience_id = audience['id']
+        try:
+            audience_id = self._audience_index()[audience_name]
+        except KeyError:
+            raise ValueError('Attempted to get audience. Audience does not exist.')
         
-        target = CustomAudience(audience_id)
+        target = CustomAudience(audience_id, api=self.__api)
         
         return target
     
     def _batch_users(self, obj, size=2500):
         """ This returns a generator that returns a list 
-        of lists of a specific size.
+        of lists of a specific size. Works on any iterable and
+        holds one batch at a time.
         
-        :params obj: list, users list that needs to be batched
+        :params obj: iterable, users that need to be batched
         :params size: int, the batch size
         """
-        for chunk in range(0, len(obj), size):
-            try:
-                yield obj[chunk:chunk + size]
-            except IndexError:
-                yield obj[chunk:len(obj)]
+        users = iter(obj)
+        batch = list(itertools.islice(users, size))
+        while batch:
+            yield batch
+            batch = list(itertools.islice(users, size))
     
     def create_audience(self, name, desc=None):
         """ This creates an audience object.
@@ -223,83 +399,626 @@ class Adapter:
         :params name: str, name of audience
         :params desc: str, description of audience
         """
-        if name in [audience['name'] for audience in self.audiences]:
+        if name in self._audience_index():
             raise ValueError('Attempted to add audience. Audience with same name exists.')
         
-        audience = CustomAudience(parent_id=self._account)
+        audience = CustomAudience(parent_id=self._account, api=self.__api)
         audience[CustomAudience.Field.subtype] = CustomAudience.Subtype.custom
         audience[CustomAudience.Field.name] = '{}'.format(name)
         
         if desc:
             audience[CustomAudience.Field.description] = desc
         audience.remote_create()
+        self._audience_ids[name] = audience[CustomAudience.Field.id]
+        with self._db_lock:  # A new audience starts out empty.
+            self.__members.delete().where(self.__members.audience == name).execute()
     
     def delete_audience(self, name):
         """ This deletes an audience object.
         
         :params name: str, name of audience
         """
-        if name not in [audience['name'] for audience in self.audiences]:
+        if name not in self._audience_index():
             raise ValueError('Attempted to remove audience. Audience does not exist.')
         
-        for audience in list(self.audiences):
-            if audience['name'] == name:
-                delete_id = audience['id']
-        
-        audience = CustomAudience(delete_id)
+        audience = CustomAudience(self._audience_ids[name], api=self.__api)
         audience.remote_delete()
+        del self._audience_ids[name]
     
     def add_users(self, name, users):
         """ This bulk adds users to an audience object.
         
         :params name: str, name of audience
-        :params users: list, list of users
+        :params users: iterable, users (a list, Users or a generator)
+        """
+        self.upload([('add', name, users)])
+        
+    def remove_users(self, name, users):
+        """ This bulk deletes users from an audience object.
+        
+        :params name: str, name of audience
+        :params users: iterable, users (a list, Users or a generator)
+        """
+        self.upload([('remove', name, users)])
+    
+    def upload(self, jobs):
+        """ This runs several add and remove jobs, for any number of
+        audiences, as one pool of batches: every remove batch goes
+        through before the first add batch. It returns once every
+        batch has gone through and raises the first failure.
+        
+        The users are read lazily and journaled batch by batch; the
+        batches are read back and cut again to the current batch size
+        as they are sent, so memory stays at a few batches however many
+        users there are. After a failure the rest can be sent with
+        resume().
+        
+        :params jobs: list, (action, name, users) tuples where action
+        is 'add' or 'remove' and users any iterable
+        
+        return :: dict, (action, name) -> number of users
+        """
+        with metrics.stage('upload'):
+            job, counts = self.journal(jobs)
+            self._send_entries(self._pending(job), echo=True)
+        
+        return counts
+    
+    def journal(self, jobs):
+        """ This reads the users of every job lazily, batch by batch,
+        and writes a pending journal entry for each batch, without
+        sending anything. Called inside a transaction, the entries are
+        committed with it; send() uploads them.
+        
+        :params jobs: list, (action, name, users) tuples where action
+        is 'add' or 'remove' and users any iterable
+        
+        return :: tuple, (job id, dict of (action, name) -> number of users)
         """
-        if not len(users):
-            return print('Attempted to add users. No users in the list.')
+        self._load_batch_sizes()
+        job = uuid.uuid4().hex
+        journal = self.__journal
+        counts = {}
         
-        print('Adding {} users to {}'.format(len(users), name))
+        with journal._meta.database.atomic():
+            for action, name, users in jobs:
+                if isinstance(users, str):
+                    raise TypeError
+                offset = counts.get((action, name), 0)
+                batches = self._batch_users(users, size=self._sizer.size(action))
+                for number, batch in enumerate(batches):
+                    if not number:
+                        self._get_audience(name)  # the audience has to exist
+                    journal.create(job=job, audience=name, action=action,
+                                   offset=offset, size=len(batch),
+                                   digest=self._digest(batch),
+                                   users='\n'.join(batch))
+                    offset += len(batch)
+                counts[(action, name)] = offset
+                
+                verb = 'add' if action == 'add' else 'remove'
+                if not offset:
+                    print('Attempted to {} users. No users in the list.'.format(verb))
+                else:
+                    print('{} {} users to {}'.format(
+                        'Adding' if action == 'add' else 'Removing', offset, name))
         
-        if not isinstance(users, list):
-            raise TypeError
+        return job, counts
+    
+    def send(self, job):
+        """ This sends the batches of a job written with journal() and
+        clears the job once every batch has gone through.
+        
+        :params job: str, job id
+        
+        return :: int, number of batches sent
+        """
+        with metrics.stage('upload'):
+            return self._send_entries(self._pending(job), echo=True)
+    
+    def resume(self):
+        """ This sends the journaled batches that were never
+        acknowledged, job by job in the order the jobs were journaled,
+        and clears each job once it is through.
+        
+        return :: int, number of batches sent
+        """
+        entries = self._pending()
+        for entry_id, job, action, name, offset, size in entries:
+            print('Resuming {} of {} users at offset {} for {}'.format(
+                action, size, offset, name))
+        
+        return self._send_entries(entries)
+    
+    def sync(self, audiences):
+        """ This brings audiences in line with segment membership by
+        uploading only the difference between the customers table and
+        the audience_members record: removes first, then adds.
+        
+        An audience with no record yet (filled outside this Adapter)
+        gets its whole segment added once; adds are idempotent.
+        
+        :params audiences: list, (audience name, segment) tuples
+        
+        return :: dict, audience name -> (added, removed) counts
+        """
+        counts = self.upload(
+            [('remove', name, self._difference(name, segment, 'remove'))
+             for name, segment in audiences] +
+            [('add', name, self._difference(name, segment, 'add'))
+             for name, segment in audiences])
+        
+        return {name: (counts[('add', name)], counts[('remove', name)])
+                for name, segment in audiences}
+    
+    def _pending(self, job=None):
+        """ This lists the journal entries never acknowledged, of one
+        job or of all, job by job in the order the jobs were journaled.
+        A job keeps its first entry id until it is cleared (_cut
+        rewrites the first entry it runs across in place).
         
-        target = self._get_audience(name)
+        :params job: str, job id; None = every job
         
-        if len(users) > 10000:  # User add limit is ~10000.
-            batches = self._batch_users(users)
-            for batch in batches:
-                post_ = target.add_users(CustomAudience.Schema.email_hash, batch, is_raw=True)
-                pprint.pprint(post_._body)
+        return :: list of (journal id, job id, action, name, offset, size) tuples
+        """
+        sql = ('SELECT "id", "job", "action", "audience", "offset", "size" '
+               'FROM {0} AS entry WHERE "acknowledged" IS NULL{1} '
+               'ORDER BY (SELECT MIN("id") FROM {0} WHERE "job" = entry."job"), '
+               '"id"').format(self.__journal._meta.db_table,
+                              ' AND "job" = ?' if job else '')
+        with self._db_lock:
+            return list(self.__journal._meta.database.execute_sql(
+                sql, (job,) if job else ()))
+    
+    def _send_entries(self, entries, echo=False):
+        """ This sends journaled entries job by job, removes before adds
+        within each job, and clears each job once it is through, so a
+        later job's changes are never undone by an earlier one's.
+        
+        :params entries: list, (journal id, job id, action, name, offset,
+        size) tuples in the order of _pending
+        :params echo: boolean, print the responses of adds that take
+        more than one batch
+        
+        return :: int, number of batches sent
+        """
+        self._load_batch_sizes()
+        targets, sent = {}, 0
+        try:
+            for job, rows in itertools.groupby(entries, key=lambda entry: entry[1]):
+                rows = list(rows)
+                totals = {}
+                for entry_id, job, action, name, offset, size in rows:
+                    totals[(action, name)] = totals.get((action, name), 0) + size
+                calls = []
+                for entry_id, job, action, name, offset, size in rows:
+                    if name not in targets:
+                        targets[name] = self._get_audience(name)
+                    calls.append((entry_id, action, name, targets[name], None,
+                                  echo and action == 'add' and
+                                  totals[(action, name)] > self._sizer.size(action)))
+                sent += self._run_calls(calls)
+                self._clear_journal(job)
+        finally:
+            self._save_batch_sizes()
+        
+        return sent
+    
+    def _run_calls(self, calls):
+        """ This sends batch calls, removes before adds, packed into
+        Graph API batch requests and concurrently within each phase
+        when workers > 1. Batches are cut to the endpoint's current
+        size as each request is packed, so sizes the sizer shrank or
+        grew during the run apply to the batches still to go.
+        
+        :params calls: list, (journal id, action, name, target, batch, echo)
+        
+        return :: int, number of batches sent
+        """
+        sent = 0
+        for action in ('remove', 'add'):
+            batches = self._cut([call for call in calls if call[1] == action])
+            requests = self._requests(action, batches)
+            if self._workers > 1:
+                with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                    running = set()
+                    while True:
+                        if len(running) >= self._workers:  # cut once a worker is free
+                            done, running = wait(running,
+                                                 return_when=FIRST_COMPLETED)
+                            for future in done:
+                                future.result()
+                        group = next(requests, None)
+                        if group is None:
+                            break
+                        running.add(pool.submit(self._send_many, group))
+                        sent += len(group)
+                    for future in running:
+                        future.result()
+            else:
+                for group in requests:
+                    self._send_many(group)
+                    sent += len(group)
+        
+        return sent
+    
+    def _requests(self, action, batches):
+        """ This packs batch calls into Graph API batch requests of at
+        most API_BATCH_CALLS calls and about API_BATCH_USERS users at
+        the endpoint's current size, lazily.
+        
+        :params action: str, 'add' or 'remove'
+        :params batches: iterable, (journal id, action, name, target,
+        batch, echo) tuples
+        
+        return :: generator of lists of calls
+        """
+        group = []
+        for call in batches:
+            group.append(call)
+            if len(group) >= max(1, min(self._request_calls,
+                                        self._request_users // self._sizer.size(action))):
+                yield group
+                group = []
+        if group:
+            yield group
+    
+    def _cut(self, calls):
+        """ This re-slices journaled batches to the endpoint's current
+        size as they are sent, one batch at a time. Consecutive batches
+        for the same audience are read back in order and cut again; the
+        first journal entry a cut runs across is rewritten to the batch
+        cut and the others replaced by what is left of them, in one
+        transaction.
+        
+        :params calls: list, (journal id, action, name, target, None, echo)
+        of one phase
+        
+        return :: generator of (journal id, action, name, target, batch,
+        echo) tuples
+        """
+        journal = self.__journal
+        for name, group in itertools.groupby(calls, key=lambda call: call[2]):
+            group = list(group)
+            action, target, echo = group[0][1], group[0][3], group[0][5]
+            entry_ids = iter([call[0] for call in group])
+            held, users = [], []
+            while True:
+                size = self._sizer.size(action)
+                while len(users) < size:
+                    entry_id = next(entry_ids, None)
+                    if entry_id is None:
+                        break
+                    job_, offset_, batch = self._journaled_entry(entry_id)
+                    if not held:
+                        job, offset = job_, offset_
+                    held.append(entry_id)
+                    users.extend(batch)
+                if not users:
+                    break
+                batch, users = users[:size], users[size:]
+                if len(held) == 1 and not users:  # the entry as journaled
+                    yield held[0], action, name, target, batch, echo
+                    held = []
+                    continue
+                with self._db_lock, journal._meta.database.atomic():
+                    journal.update(offset=offset, size=len(batch),
+                                   digest=self._digest(batch),
+                                   users='\n'.join(batch)).where(
+                        journal.id == held[0]).execute()
+                    journal.delete().where(journal.id << held[1:]).execute()
+                    entry_id = held[0]
+                    offset += len(batch)
+                    held = [journal.create(job=job, audience=name, action=action,
+                                           offset=offset, size=len(users),
+                                           digest=self._digest(users),
+                                           users='\n'.join(users)).id] if users else []
+                yield entry_id, action, name, target, batch, echo
+    
+    def _send_many(self, calls):
+        """ This sends several journaled batches as one Graph API batch
+        request and acknowledges each that went through. A call that
+        failed inside the batch is sent again on its own, with retries
+        and splitting; the first one that cannot succeed is raised once
+        the rest of the batch is recorded. The batch sizer sees the
+        request once per endpoint, with its whole latency, and every
+        entry that went through is timed under its audience and action.
+        
+        :params calls: list, (journal id, action, name, target, batch, echo)
+        """
+        if len(calls) == 1:
+            return self._send(*calls[0])
+        
+        calls = [(entry_id, action, name, target,
+                  self._journaled_users(entry_id) if batch is None else batch, echo)
+                 for entry_id, action, name, target, batch, echo in calls]
+        entries = [self._batch_request(action, target, batch)
+                    for entry_id, action, name, target, batch, echo in calls]
+        
+        errors, seconds = [], []
+        
+        def call():
+            start = time.perf_counter()
+            response = self.__api.call('POST', (), params={'batch': entries})
+            seconds.append(time.perf_counter() - start)
+            return response
+        
+        started = time.perf_counter()
+        with metrics.timer('api_batch_seconds'):
+            post_ = call_with_retry(call, bucket=self._bucket,
+                                    on_error=errors.append)
+        elapsed = time.perf_counter() - started
+        metrics.count('api_batches')
+        
+        throttled = set()
+        if any(is_throttled(error) for error in errors):
+            throttled = {call_[1] for call_ in calls}
+        answered, failure = set(), None
+        for call_, entry, answer in zip(calls, entries, post_.json()):
+            entry_id, action, name, target, batch, echo = call_
+            if answer is None:  # timed out inside the batch
+                failure = failure or self._send_alone(call_)
+                continue
+            response = FacebookResponse(body=answer.get('body'),
+                                        http_status=answer.get('code'),
+                                        call=entry)
+            if response.is_failure():
+                error = response.error()
+                if is_throttled(error):
+                    throttled.add(action)
+                if is_retryable(error) or is_oversized(error):
+                    failure = failure or self._send_alone(call_)
+                else:
+                    failure = failure or error
+                continue
+            answered.add(action)
+            metrics.observe('api_seconds', elapsed, audience=name, action=action)
+            metrics.count('api_calls', audience=name, action=action)
+            metrics.count('users_uploaded', len(batch), audience=name, action=action)
+            if echo:
+                pprint.pprint(response._body)
+            if self._pre_hashed:
+                self._track(action, name, batch)
+            self._acknowledge(entry_id)
+        
+        for action in answered | throttled:
+            self._sizer.record(action, max(len(call_[4]) for call_ in calls
+                                           if call_[1] == action),
+                               seconds[-1], throttled=action in throttled)
+        if failure:
+            raise failure
+    
+    def _send_alone(self, call):
+        """ This sends one call of a batch request again on its own and
+        returns the error it gave up on, if any, so the rest of the
+        batch is still acknowledged.
+        
+        :params call: tuple, (journal id, action, name, target, batch, echo)
+        
+        return :: Exception or None
+        """
+        try:
+            self._send(*call)
+        except Exception as error:
+            return error
+    
+    def _batch_request(self, action, target, batch):
+        """ This describes one users call as an entry of a Graph API
+        batch request.
+        
+        :params action: str, 'add' or 'remove'
+        :params target: CustomAudience, the audience object
+        :params batch: list, list of users
+        
+        return :: dict, batch entry
+        """
+        params = CustomAudience.format_params(
+            CustomAudience.Schema.email_hash, batch, is_raw=action == 'add',
+            pre_hashed=self._pre_hashed)
+        
+        return {'method': 'POST' if action == 'add' else 'DELETE',
+                'relative_url': '{}/users'.format(target.get_id_assured()),
+                'body': urllib.parse.urlencode(
+                    {'payload': json.dumps(params['payload'])})}
+    
+    def _load_batch_sizes(self):
+        """ This restores the batch sizes tuned in earlier runs, once.
+        """
+        if self._sizes_loaded:
+            return
+        sizes = self.__batch_sizes
+        with self._db_lock:
+            self._sizer.restore(dict(sizes.select(sizes.endpoint, sizes.size)
+                                     .tuples()))
+        self._sizes_loaded = True
+    
+    def _save_batch_sizes(self):
+        """ This stores the current batch sizes for the next run.
+        """
+        sizes = self.__batch_sizes
+        updated = datetime.now().isoformat()
+        with self._db_lock, sizes._meta.database.atomic():
+            for endpoint, size in self._sizer.sizes.items():
+                sizes.insert(endpoint=endpoint, size=size,
+                             updated=updated).upsert().execute()
+    
+    def _journaled_entry(self, entry_id):
+        """ This reads a journaled batch back and checks it against
+        its digest.
+        
+        :params entry_id: int, journal entry id
+        
+        return :: tuple, (job id, offset, list of users)
+        """
+        journal = self.__journal
+        with self._db_lock:
+            job, offset, digest, users = (
+                journal.select(journal.job, journal.offset, journal.digest,
+                               journal.users)
+                .where(journal.id == entry_id).tuples().get())
+        users = users.split('\n')
+        if self._digest(users) != digest:
+            raise ValueError('Attempted to upload. Batch {} of {} '
+                             'is corrupt.'.format(entry_id, job))
+        
+        return job, offset, users
+    
+    def _journaled_users(self, entry_id):
+        """ This reads the users of a journaled batch back.
+        
+        :params entry_id: int, journal entry id
+        
+        return :: list of users
+        """
+        journal = self.__journal
+        users = (journal.select(journal.users).where(journal.id == entry_id)
+                 .tuples().get()[0])
+        
+        return users.split('\n')
+    
+    def _acknowledge(self, entry_id):
+        """ This marks a journaled batch as acknowledged and drops its users.
+        
+        :params entry_id: int, journal entry id
+        """
+        journal = self.__journal
+        with self._db_lock:
+            journal.update(acknowledged=datetime.now().isoformat(), users=None).where(
+                journal.id == entry_id).execute()
+    
+    def _clear_journal(self, job):
+        """ This deletes a job's entries once all of them are acknowledged.
+        
+        :params job: str, job id
+        """
+        journal = self.__journal
+        with self._db_lock:
+            journal.delete().where(journal.job == job).execute()
+    
+    @staticmethod
+    def _digest(batch):
+        """ This returns the content hash of a batch of users.
+        
+        :params batch: list, list of users
+        """
+        return hashlib.sha256('\n'.join(batch).encode('utf8')).hexdigest()
+    
+    def _difference(self, name, segment, action):
+        """ This computes one side of a sync as a set difference in SQL.
+        
+        :params name: str, name of audience
+        :params segment: str, segment the audience should hold
+        :params action: str, 'add' (desired - held) or 'remove' (held - desired)
+        
+        return :: Users, email hashes read as they are consumed
+        """
+        desired = ('SELECT email_hash FROM {} WHERE segment = ? '
+                   'AND email_hash IS NOT NULL'.format(self.__customers._meta.db_table))
+        held = 'SELECT email_hash FROM {} WHERE audience = ?'.format(
+            self.__members._meta.db_table)
+        
+        if action == 'add':
+            sql, params = '{} EXCEPT {}'.format(desired, held), (segment, name)
         else:
-            post_ = target.add_users(CustomAudience.Schema.email_hash, users, is_raw=True)
+            sql, params = '{} EXCEPT {}'.format(held, desired), (name, segment)
         
-    def remove_users(self, name, users):
-        """ This bulk deletes users from an audience object.
+        return Users(self.__customers.raw(sql, *params))
+    
+    def _track(self, action, name, batch):
+        """ This records an acknowledged batch in audience_members.
         
+        :params action: str, 'add' or 'remove'
         :params name: str, name of audience
-        :params users: list, list of users
+        :params batch: list, email hashes
         """
-        if not len(users):
-            return print('Attempted to remove users. No users in the list.')
+        members = self.__members
+        with self._db_lock, members._meta.database.atomic():
+            if action == 'add':
+                rows = [{'audience': name, 'email_hash': email_hash}
+                        for email_hash in batch]
+                for step in range(0, len(rows), 450):  # 2 variables per row
+                    members.insert_many(rows[step:step + 450]).on_conflict(
+                        action='IGNORE').execute()
+            else:
+                for step in range(0, len(batch), 900):
+                    members.delete().where(
+                        (members.audience == name) &
+                        (members.email_hash << batch[step:step + 900])).execute()
+    
+    def _send(self, entry_id, action, name, target, batch, echo=False):
+        """ This uploads one journaled batch and acknowledges it.
         
-        print('Removing {} users to {}'.format(len(users), name))
+        :params entry_id: int, journal entry id
+        :params action: str, 'add' or 'remove'
+        :params name: str, name of audience
+        :params target: CustomAudience, the audience object
+        :params batch: list, list of users; None reads it from the journal
+        :params echo: boolean, print the response body
+        """
+        if batch is None:
+            batch = self._journaled_users(entry_id)
+        post_ = self._post(action, name, target, batch, echo)
+        self._acknowledge(entry_id)
         
-        if not isinstance(users, list):
-            raise TypeError
+        return post_
+    
+    def _post(self, action, name, target, batch, echo=False):
+        """ This makes one rate-limited, retried upload call, feeds
+        its latency and errors to the batch sizer and records the
+        acknowledged batch. A batch refused as too large is sent
+        again in halves.
         
-        target = self._get_audience(name)
+        :params action: str, 'add' or 'remove'
+        :params name: str, name of audience
+        :params target: CustomAudience, the audience object
+        :params batch: list, list of users
+        :params echo: boolean, print the response body
         
-        if len(users) > 500:  # User delete limit is 500 < x < 1000.
-            batches = self._batch_users(users, size=500)
-            for batch in batches:
-                target.remove_users(CustomAudience.Schema.email_hash, batch)
+        return :: the response of the last call
+        """
+        if action == 'add':
+            method, is_raw = target.add_users, True
         else:
-            target.remove_users(CustomAudience.Schema.email_hash, users)
+            method, is_raw = target.remove_users, False
+        
+        errors, seconds = [], []
+        
+        def call():
+            start = time.perf_counter()
+            response = method(CustomAudience.Schema.email_hash, batch,
+                              is_raw=is_raw, pre_hashed=self._pre_hashed)
+            seconds.append(time.perf_counter() - start)
+            return response
+        
+        try:
+            with metrics.timer('api_seconds', audience=name, action=action):
+                post_ = call_with_retry(call, bucket=self._bucket,
+                                        on_error=errors.append)
+        except Exception as error:
+            if not is_oversized(error) or len(batch) < 2:
+                raise
+            self._sizer.shrink(action, len(batch))
+            print('Splitting a batch of {} users refused as too large'.format(
+                len(batch)))
+            half = len(batch) // 2
+            self._post(action, name, target, batch[:half], echo)
+            return self._post(action, name, target, batch[half:], echo)
+        
+        self._sizer.record(action, len(batch), seconds[-1],
+                           throttled=any(is_throttled(error) for error in errors))
+        metrics.count('api_calls', audience=name, action=action)
+        metrics.count('users_uploaded', len(batch), audience=name, action=action)
+        if echo:
+            pprint.pprint(post_._body)
+        if self._pre_hashed:
+            self._track(action, name, batch)
+        
+        return post_
     
     @property
     def audiences(self):
-        return AdAccount(self._account).get_custom_audiences(
-            fields=[CustomAudience.Field.name, CustomAudience.Field.id])
+        return [{'name': name, 'id': audience_id}
+                for name, audience_id in self._audience_index().items()]
     
     def __str__(self):
         return '<[Adapter Object]>'
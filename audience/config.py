@@ -1,7 +1,11 @@
 """
 config -- credentials and paths
+
+This module holds the defaults. A client configuration file is a
+Python file setting any of the same names; read it with load().
 """
 import os
+import types
 
 # base directory
 
@@ -15,10 +19,27 @@ DATABASE_SCHEMA = os.path.join(_basedir, "customers.sql")
 # ftp credentials
 
 FTP_HOST = None
+FTP_PORT = 21
 FTP_USER = None
 FTP_PASSWORD = None
 FTP_DIR = None
 
+# file source
+
+SOURCE = 'ftp'  # 'ftp' = the FTP server above; 'local' = the files in SOURCE_DIR
+SOURCE_DIR = None  # local or NFS directory of customer files, e.g. for a backfill
+
+# ftp ingest options
+
+FTP_STREAM = False  # decode csv files off the socket, one batch in memory
+FTP_WORKERS = 1  # > 1 reads and parses files in parallel, each held whole in memory
+HASH_PROCESSES = None  # processes hashing emails at import; None = in-process
+PARSE_PROCESSES = None  # processes parsing spooled csv files in byte ranges; None = in-process
+BULK_LOAD = False  # raw executemany with load pragmas; indexes rebuilt on empty tables
+MERGE_IMPORT = False  # execute/sync merge through a staging table and sort its change set
+PIPELINE_QUEUE = 4  # blocks buffered between the stages of run.py pipeline
+PIPELINE_BUSY_TIMEOUT = 60  # seconds a pipeline stage waits on another stage's write lock
+
 # facebook credentials
 
 APP_ID = None
@@ -27,26 +48,55 @@ ACCESS_TOKEN = None
 SITE_ID = None
 TESTING_SITE_ID = None
 
+# graph api upload options
+
+API_WORKERS = 1  # > 1 uploads batches for several audiences in parallel
+API_RATE = 5.0  # upload calls per second at zero reported usage
+AUDIENCE_CACHE_TTL = None  # seconds to keep the audience listing; None = whole run
+BATCH_TARGET_SECONDS = 5.0  # users calls slower than this shrink the batch size
+API_BATCH_CALLS = 50  # users calls packed into one Graph API batch request; 1 = none
+API_BATCH_USERS = 25000  # about the most users across the calls of one batch request
+API_GZIP_MINIMUM = None  # gzip request bodies of at least this many bytes; None = never
+
 # client-specific variables
 
 CURRENT = None
 LAPSED = None
 EXTRA = None
 
-# If testing, mark as True
-
-DEBUG = False
-
-
-
-
+# segmentation: recency tiers, most recent first, and the days since the
+# last order at which each tier after the first begins
 
+SEGMENTS = ('current', 'lapsed', 'extra lapsed')
+SEGMENT_DAYS = (90, 730)
+AUDIENCES = None  # (audience name, segment) pairs; None = CURRENT, LAPSED and EXTRA for three SEGMENTS
 
+# JSON-lines file for run metrics; None = not written
 
+METRICS_PATH = None
 
+# If testing, mark as True
 
+DEBUG = False
 
 
+def load(path):
+    """ Read a client configuration file into a module of its own.
+    Names the file leaves out keep the defaults above, except
+    DATABASE_PATH, which defaults to a database next to the file so
+    that no two clients share one.
 
+    :params path: str, client configuration file
 
+    return :: module, configuration
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    client = types.ModuleType(name)
+    client.__dict__.update((key, value) for key, value in globals().items()
+                           if key.isupper())
+    client.DATABASE_PATH = os.path.splitext(os.path.abspath(path))[0] + '.db'
+    client.__file__ = path
+    with open(path) as handle:
+        exec(compile(handle.read(), path, 'exec'), client.__dict__)
 
+    return client
@@ -6,8 +6,40 @@ create table customers (
 	sell_to_customer_name text(60),
 	ship_to_post_code text(60),
 	usa_email text(60),
+	email_hash text(64),
 	total_number_of_orders text(5),
 	segment text(15),
 	record_create_date text(15),
 	file_parse_date text(15)
 );
+
+create table ingested_files (
+	name text primary key,
+	size integer,
+	modified text(14),
+	ingest_date text(15)
+);
+
+create table audience_members (
+	audience text not null,
+	email_hash text not null,
+	primary key (audience, email_hash)
+);
+
+create table upload_journal (
+	id integer primary key,
+	job text not null,
+	audience text not null,
+	action text not null,
+	offset integer not null,
+	size integer not null,
+	digest text(64) not null,
+	users text,
+	acknowledged text(26)
+);
+
+create table batch_sizes (
+	endpoint text primary key,
+	size integer not null,
+	updated text(26)
+);
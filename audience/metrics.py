@@ -0,0 +1,182 @@
+"""
+metrics -- structured run metrics and profiling
+
+Stages, counters and latency samples are collected in the module-level
+`metrics` registry. Every finished stage, and the run summary, can be
+written as one JSON object per line to a file (config.METRICS_PATH or
+run.py --metrics).
+"""
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+class Metrics:
+    """ A thread-safe registry of stage timings, counters and
+    latency samples. Names take optional labels, e.g.
+    observe('api_seconds', 0.4, audience='Current').
+
+    :params path: str, JSON-lines file to append events to
+
+    return :: metrics.Metrics object
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self.configure(path)
+
+    def configure(self, path=None):
+        """ Reset the registry and (re)point its output file.
+
+        :params path: str, JSON-lines file to append events to
+        """
+        with self._lock:
+            self._path = path
+            self._stages = {}
+            self._counters = {}
+            self._samples = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the block as a named stage and emit it when done.
+
+        :params name: str, stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._stages[name] = self._stages.get(name, 0.0) + seconds
+            self.emit({'event': 'stage', 'stage': name, 'seconds': seconds})
+
+    def count(self, name, value=1, **labels):
+        """ Add to a counter.
+
+        :params name: str, counter name
+        :params value: number, amount to add
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Record one latency (or other) sample.
+
+        :params name: str, sample name
+        :params value: float, sample value
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._samples.setdefault(key, []).append(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observe the duration of the block in seconds.
+
+        :params name: str, sample name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self):
+        """ Stage seconds, counters, sample percentiles and the ingest
+        rate as one dictionary.
+        """
+        with self._lock:
+            stages = dict(self._stages)
+            counters = dict(self._counters)
+            samples = {key: _percentiles(values)
+                       for key, values in self._samples.items()}
+
+        rows, seconds = counters.get('rows_imported', 0), stages.get('ingest')
+        return {'stages': stages, 'counters': counters, 'latency': samples,
+                'rows_per_second': rows / seconds if seconds else None}
+
+    def emit(self, event):
+        """ Append an event to the metrics file, when one is set.
+
+        :params event: dict, JSON-serializable event
+        """
+        if not self._path:
+            return
+        event = dict(event, time=time.time())
+        with self._lock, open(self._path, 'a') as handle:
+            handle.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def flush(self):
+        """ Emit the run summary.
+        """
+        self.emit(dict(self.summary(), event='summary'))
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return '{}{{{}}}'.format(name, ','.join(
+            '{}={}'.format(key, labels[key]) for key in sorted(labels)))
+
+    def __str__(self):
+        return '<[Metrics Object]>'
+
+    def __repr__(self):
+        return '<Metrics Object [{}]>'.format(self._path)
+
+
+def _percentiles(values):
+    """ Count, p50, p90, p99 and max of a list of samples.
+
+    :params values: list, samples
+    """
+    ordered = sorted(values)
+
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {'count': len(ordered), 'p50': pick(0.5), 'p90': pick(0.9),
+            'p99': pick(0.99), 'max': ordered[-1]}
+
+
+@contextmanager
+def profiled(path, top=40):
+    """ Profile the block with cProfile and tracemalloc. Writes
+    path.pstats (for pstats/snakeviz) and a readable path.txt with
+    the top functions by cumulative time and the top allocation sites.
+
+    :params path: str, report path without extension
+    :params top: int, lines per section of the text report
+    """
+    profile = cProfile.Profile()
+    tracemalloc.start()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profile.dump_stats(path + '.pstats')
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(top)
+        text.write('\npython memory: {:.1f} MB current, {:.1f} MB peak\n\n'.format(
+            current / 2 ** 20, peak / 2 ** 20))
+        for stat in snapshot.statistics('lineno')[:top]:
+            text.write('{}\n'.format(stat))
+        with open(path + '.txt', 'w') as handle:
+            handle.write(text.getvalue())
+        print('Profile written to {0}.pstats and {0}.txt'.format(path))
+
+
+metrics = Metrics()
@@ -1,5 +1,6 @@
 from . import config 
-from peewee import TextField, SqliteDatabase, Model
+from peewee import (TextField, IntegerField, SqliteDatabase, Model,
+                    CompositeKey)
 
 database = SqliteDatabase(config.DATABASE_PATH, **{})
 
@@ -21,9 +22,135 @@ class customers(MiniStorage):
     ship_to_post_code = TextField(null=True)
     total_number_of_orders = TextField(null=True)
     usa_email = TextField(null=True)
+    email_hash = TextField(null=True)
     record_create_date = TextField(null=True)
     file_parse_date = TextField(null=True)
     
     class Meta:
         db_table = 'customers'
 
+
+class ingested_files(MiniStorage):
+    """ Model for 'ingested_files' table, the ledger of
+    FTP files that have already been imported.
+    """
+    name = TextField(primary_key=True)
+    size = IntegerField(null=True)
+    modified = TextField(null=True)
+    ingest_date = TextField(null=True)
+
+    class Meta:
+        db_table = 'ingested_files'
+
+
+class audience_members(MiniStorage):
+    """ Model for 'audience_members' table, the email hashes each
+    Facebook audience holds as far as acknowledged uploads go.
+    """
+    audience = TextField()
+    email_hash = TextField()
+
+    class Meta:
+        db_table = 'audience_members'
+        primary_key = CompositeKey('audience', 'email_hash')
+
+
+class upload_journal(MiniStorage):
+    """ Model for 'upload_journal' table, one row per upload batch.
+    A batch keeps its users until the API acknowledges it.
+    """
+    job = TextField()
+    audience = TextField()
+    action = TextField()
+    offset = IntegerField()
+    size = IntegerField()
+    digest = TextField()
+    users = TextField(null=True)
+    acknowledged = TextField(null=True)
+
+    class Meta:
+        db_table = 'upload_journal'
+
+
+class batch_sizes(MiniStorage):
+    """ Model for 'batch_sizes' table, the users per call tuned
+    for each Graph API endpoint, kept between runs.
+    """
+    endpoint = TextField(primary_key=True)
+    size = IntegerField()
+    updated = TextField(null=True)
+
+    class Meta:
+        db_table = 'batch_sizes'
+
+
+# (index name, table, columns) -- secondary indexes for the Sorter queries.
+INDEXES = (
+    ('customers_segment_last_order_date', 'customers',
+     ('segment', 'last_order_date')),
+    ('customers_segment_email_hash', 'customers',
+     ('segment', 'email_hash')),
+    ('customers_file_parse_date_email_hash', 'customers',
+     ('file_parse_date', 'email_hash')),
+)
+
+# indexes superseded by the ones above
+DROPPED_INDEXES = ('customers_segment_usa_email',
+                   'customers_file_parse_date_usa_email')
+
+# (table, column, type) -- columns added after the original schema.
+COLUMNS = (
+    ('customers', 'email_hash', 'text(64)'),
+)
+
+
+def use(path):
+    """ Point the models at a database file, closing this thread's
+    connection to the one in use. Lets one process work through
+    several clients' databases in turn.
+
+    :params path: str, database file
+    """
+    if not database.is_closed():
+        database.close()
+    if database.database != path:
+        database.init(path)
+
+
+def migrate():
+    """ Bring a database written from an older schema up to date.
+    Safe to run against a database that is already current.
+    """
+    ingested_files.create_table(fail_silently=True)
+    audience_members.create_table(fail_silently=True)
+    upload_journal.create_table(fail_silently=True)
+    batch_sizes.create_table(fail_silently=True)
+    for table, column, kind in COLUMNS:
+        if column not in [c.name for c in database.get_columns(table)]:
+            database.execute_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table, column, kind))
+    for name in DROPPED_INDEXES:
+        database.execute_sql('DROP INDEX IF EXISTS {}'.format(name))
+    create_indexes()
+
+
+def create_indexes(table=None):
+    """ Create the secondary indexes that do not exist yet.
+
+    :params table: str, only this table's indexes; None = all
+    """
+    for name, on, columns in INDEXES:
+        if table in (None, on):
+            database.execute_sql('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                name, on, ', '.join(columns)))
+
+
+def drop_indexes(table):
+    """ Drop a table's secondary indexes, e.g. ahead of a bulk load.
+    Rebuild them with create_indexes(table).
+
+    :params table: str, name of table
+    """
+    for name, on, columns in INDEXES:
+        if on == table:
+            database.execute_sql('DROP INDEX IF EXISTS {}'.format(name))
@@ -0,0 +1,209 @@
+"""
+pipeline -- overlapped download, load and upload
+
+The on-going flow as one asyncio pipeline. Three stages run at the
+same time, joined by bounded queues so a slow stage holds the ones
+before it back instead of letting blocks pile up in memory:
+
+    ::::> read and parse (FTP or a local directory, then hashing) on a producer thread
+    ::::> merge into SQLite on a single database thread, journaling
+          each block's uploads in the same transaction
+    ::::> send each journaled job through the Adapter
+
+Every blocking call runs on an executor; the event loop only moves
+blocks between queues. Audiences see the aging moves first and then
+the change set of every merged block, in order. A change set that is
+committed is also journaled, so after a failed run resume() sends
+whatever the audiences did not get.
+"""
+import gc
+import asyncio
+import threading
+import multiprocessing
+
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+from . import models
+from .audience import Sorter
+from .metrics import metrics
+from .sources import stream_source, source_for
+from .utils import tiers, HASH_BLOCK, data_generator, hash_records, merge_block
+
+_DONE = object()
+
+
+def run_pipeline(config, adapter, audiences, keyword='_', ledger=None):
+    """ Run the on-going flow as a pipeline and block until every
+    stage is done.
+
+    :params config: module, configuration
+    :params adapter: audience.Adapter, connected to the account
+    :params audiences: list, (audience name, segment) tuples
+    :params keyword: str, keyword to filter files
+    :params ledger: list, collects the ingested files, as in stream_source
+
+    return :: int, number of blocks merged
+    """
+    # The stages write on separate connections: wait for each other's
+    # transactions instead of failing with SQLITE_BUSY.
+    timeout = models.database.connect_kwargs.get('timeout')
+    models.database.connect_kwargs['timeout'] = config.PIPELINE_BUSY_TIMEOUT
+    journal_mode = _enable_wal()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _pipeline(config, adapter, audiences, keyword, ledger))
+    finally:
+        loop.close()
+        if timeout is None:
+            del models.database.connect_kwargs['timeout']
+        else:
+            models.database.connect_kwargs['timeout'] = timeout
+        # Leaving WAL needs the only connection to the file. The stage
+        # threads are gone, but their connections can still sit in
+        # reference cycles until collected.
+        gc.collect()
+        models.database.execute_sql('PRAGMA journal_mode = {}'.format(journal_mode))
+
+
+async def _pipeline(config, adapter, audiences, keyword, ledger):
+    loop = asyncio.get_event_loop()  # the running loop
+    blocks = asyncio.Queue(maxsize=config.PIPELINE_QUEUE)
+    uploads = asyncio.Queue(maxsize=config.PIPELINE_QUEUE)
+    stop = threading.Event()
+    database = ThreadPoolExecutor(max_workers=1)  # one sqlite connection
+    threads = ThreadPoolExecutor(max_workers=2)  # producer, uploader
+    pool = multiprocessing.Pool(config.HASH_PROCESSES) if config.HASH_PROCESSES else None
+
+    def put(item):
+        # Blocks while the queue is full; gives up once the run stops.
+        while not stop.is_set():
+            future = asyncio.run_coroutine_threadsafe(blocks.put(item), loop)
+            try:
+                return future.result(timeout=1)
+            except futures.TimeoutError:
+                if not future.cancel():
+                    return
+
+    def produce():
+        records = stream_source(source_for(config), keyword=keyword, stream=True,
+                                workers=config.FTP_WORKERS, ledger=ledger,
+                                processes=config.PARSE_PROCESSES)
+        try:
+            for block in data_generator(records, HASH_BLOCK):
+                if stop.is_set():
+                    return
+                with metrics.timer('hash_block_seconds'):
+                    hash_records(block, pool)
+                put(block)
+        finally:
+            records.close()
+            put(_DONE)
+
+    async def load():
+        job = await loop.run_in_executor(database, _journaled, adapter, audiences,
+                                         _aging_changes)
+        await uploads.put(job)
+        merged = 0
+        while True:
+            block = await blocks.get()
+            if block is _DONE:
+                break
+            job = await loop.run_in_executor(database, _journaled, adapter,
+                                             audiences, merge_block, 'customers',
+                                             block)
+            await uploads.put(job)
+            merged += 1
+        await uploads.put(_DONE)
+        return merged
+
+    async def upload():
+        while True:
+            job = await uploads.get()
+            if job is _DONE:
+                return
+            if job:
+                await loop.run_in_executor(threads, adapter.send, job)
+
+    tasks = [loop.run_in_executor(threads, produce),
+             asyncio.ensure_future(load()), asyncio.ensure_future(upload())]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        stop.set()
+        await loop.run_in_executor(None, _shutdown, threads, database, pool)
+
+    return results[1]
+
+
+def _shutdown(threads, database, pool):
+    """ Wait for the stage threads, then the hashing processes.
+    """
+    threads.shutdown(wait=True)
+    database.shutdown(wait=True)
+    if pool:
+        pool.close()
+        pool.join()
+
+
+def _journaled(adapter, audiences, change, *args):
+    """ Make a change to the customers table and journal its upload
+    jobs in the same transaction, so a change is never committed
+    without the uploads that carry it to the audiences: if the run
+    fails before they are sent, resume() sends them.
+
+    :params adapter: audience.Adapter, connected to the account
+    :params audiences: list, (audience name, segment) tuples
+    :params change: callable, makes the change and returns its change set
+    :params args: arguments of change
+
+    return :: str, job id, or None when there is nothing to upload
+    """
+    with models.database.atomic():
+        jobs = _upload_jobs(change(*args), audiences)
+        return adapter.journal(jobs)[0] if jobs else None
+
+
+def _aging_changes():
+    """ Move aged customers down a segment, as add_remove_sort does,
+    and return the moves as a change set.
+    """
+    sorter = Sorter(changes={segment: {'add': [], 'remove': []}
+                             for segment in tiers.names})
+    sorter.add_remove_sort
+
+    return {segment: {'add': sorter.adds(segment),
+                      'remove': sorter.removes(segment)}
+            for segment in tiers.names}
+
+
+def _upload_jobs(changes, audiences):
+    """ Adapter.journal jobs for a change set, removes first.
+
+    :params changes: dict, {segment: {'add': [...], 'remove': [...]}}
+    :params audiences: list, (audience name, segment) tuples
+
+    return :: list of (action, name, users) tuples
+    """
+    return ([('remove', name, changes[segment]['remove'])
+             for name, segment in audiences if changes[segment]['remove']] +
+            [('add', name, changes[segment]['add'])
+             for name, segment in audiences if changes[segment]['add']])
+
+
+def _enable_wal():
+    """ Let the uploader's journal writes interleave with the merge
+    transactions of the database thread. run_pipeline puts the
+    previous journal mode back when the stages are done.
+
+    return :: str, the journal mode before
+    """
+    previous = models.database.execute_sql('PRAGMA journal_mode').fetchone()[0]
+    models.database.execute_sql('PRAGMA journal_mode = WAL')
+
+    return previous
@@ -0,0 +1,474 @@
+"""
+sources -- where customer files are read from
+
+A source lists file names, stats files and reads the import-ready
+records of one file through the parsers in utils. stream_source walks
+any source the same way: legacy xlsx files first, then csv files in
+file-date order, skipping the files the ingested_files ledger holds.
+
+    ::::> FTPSource, the vendor FTP server in config.FTP_*
+    ::::> LocalSource, a local or NFS directory, read through memory maps
+
+source_for(config) picks one from config.SOURCE.
+"""
+import io
+import os
+import mmap
+import time
+import ftplib
+import threading
+import itertools
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import models
+from .metrics import metrics
+from .utils import (stream_csv, stream_csv_parallel, stream_xlsx,
+                    parse_csv_parallel, iter_csv_records, iter_xlsx_records,
+                    process_csv_bytestring, process_xlsx_bytestring)
+
+
+class FTPSource:
+    """ The vendor FTP server. The connection is opened on first use
+    and closed with the source; copies open their own.
+
+    :params config: module, FTP_HOST, FTP_PORT, FTP_USER, FTP_PASSWORD
+    and FTP_DIR
+
+    return :: sources.FTPSource object
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._ftp = None
+
+    @property
+    def ftp(self):
+        """ The logged in connection, in the configured directory.
+        """
+        if self._ftp is None:
+            config = self._config
+            self._ftp = ftplib.FTP()
+            self._ftp.connect(config.FTP_HOST, config.FTP_PORT)
+            self._ftp.login(config.FTP_USER, config.FTP_PASSWORD)
+            self._ftp.cwd(config.FTP_DIR)
+        return self._ftp
+
+    def copy(self):
+        """ A source on a new connection, for another thread.
+        """
+        return FTPSource(self._config)
+
+    def names(self):
+        """ The file names in the FTP directory.
+        """
+        names = self.ftp.nlst()
+        self.ftp.voidcmd('TYPE I')  # SIZE is refused in ASCII mode by some servers.
+
+        return names
+
+    def stat(self, name):
+        """ The size and modification time of a file on the server,
+        or None for whichever the server does not support.
+
+        :params name: str, file name
+
+        return :: tuple, (int size, str YYYYMMDDHHMMSS)
+        """
+        try:
+            size = self.ftp.size(name)
+        except ftplib.error_perm:
+            size = None
+        try:
+            modified = self.ftp.sendcmd('MDTM {}'.format(name)).split()[-1]
+        except ftplib.error_perm:
+            modified = None
+
+        return size, modified
+
+    def records(self, name, stream=False, pool=None):
+        """ The import-ready records of one file.
+
+        :params name: str, file name
+        :params stream: boolean, True = decode CSVs off the socket and
+        spool XLSXs to a temp file; False = download into memory
+        :params pool: multiprocessing.Pool, CSV parsing processes, or None
+
+        return :: list (or generator) of dictionaries
+        """
+        if pool and 'xlsx' not in name:
+            return stream_csv_parallel(self.ftp, name, _csv_file_date(name), pool)
+        if stream and 'xlsx' in name:
+            return stream_xlsx(self.ftp, name)
+        if stream:
+            return stream_csv(self.ftp, name, _csv_file_date(name))
+        if 'xlsx' in name:
+            return process_xlsx_bytestring(self._download(name))
+
+        return process_csv_bytestring(self._download(name), _csv_file_date(name))
+
+    def _download(self, name):
+        """ Download a whole file into memory.
+
+        :params name: str, file name on the server
+
+        return :: io.BytesIO
+        """
+        file_obj = io.BytesIO()
+        self.ftp.retrbinary('RETR {}'.format(name), file_obj.write)
+        metrics.count('bytes_downloaded', file_obj.tell())
+        metrics.count('files_downloaded')
+
+        return file_obj
+
+    def close(self):
+        if self._ftp is not None:
+            try:
+                self._ftp.quit()
+            except (OSError, EOFError):
+                pass
+            finally:
+                self._ftp.close()
+                self._ftp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return '<[FTPSource Object]>'
+
+    def __repr__(self):
+        return '<FTPSource Object [{}:{}{}]>'.format(
+            self._config.FTP_HOST, self._config.FTP_PORT, self._config.FTP_DIR)
+
+
+class LocalSource:
+    """ A local or NFS directory of customer files, for backfills and
+    re-runs of old files. Files are memory-mapped instead of read:
+    CSV rows are decoded straight from the mapped pages, XLSX archives
+    are opened on the map, and with a process pool every parsing
+    process maps its own byte ranges of the file.
+
+    :params path: str, directory
+
+    return :: sources.LocalSource object
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    def copy(self):
+        """ Nothing is held open between files, so threads share it.
+        """
+        return self
+
+    def names(self):
+        """ The file names in the directory.
+        """
+        return [name for name in os.listdir(self._path)
+                if os.path.isfile(os.path.join(self._path, name))]
+
+    def stat(self, name):
+        """ The size and modification time of a file, in the layout of
+        FTP MDTM.
+
+        :params name: str, file name
+
+        return :: tuple, (int size, str YYYYMMDDHHMMSS)
+        """
+        info = os.stat(os.path.join(self._path, name))
+
+        return info.st_size, time.strftime('%Y%m%d%H%M%S', time.gmtime(info.st_mtime))
+
+    def records(self, name, stream=False, pool=None):
+        """ The import-ready records of one file.
+
+        :params name: str, file name
+        :params stream: boolean, True = generator; False = list
+        :params pool: multiprocessing.Pool, CSV parsing processes, or None
+
+        return :: list (or generator) of dictionaries
+        """
+        path = os.path.join(self._path, name)
+        if pool and 'xlsx' not in name:
+            return parse_csv_parallel(path, _csv_file_date(name), pool)
+        records = self._mapped_records(path, name)
+        if stream:
+            return records
+
+        return list(records)
+
+    def _mapped_records(self, path, name):
+        """ Parse a file through a read-only memory map of it.
+        """
+        with open(path, 'rb') as handle:
+            if not os.fstat(handle.fileno()).st_size:
+                return  # empty files cannot be mapped
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                metrics.count('bytes_read', len(mapped))
+                metrics.count('files_read')
+                reader = io.BufferedReader(_MappedReader(mapped))
+                if 'xlsx' in name:
+                    for record in iter_xlsx_records(reader):
+                        yield record
+                    return
+                text = io.TextIOWrapper(reader, encoding='utf-8-sig',
+                                        errors='replace', newline='')
+                for record in iter_csv_records(text, _csv_file_date(name)):
+                    yield record
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        return '<[LocalSource Object]>'
+
+    def __repr__(self):
+        return '<LocalSource Object [{}]>'.format(self._path)
+
+
+class _MappedReader(io.RawIOBase):
+    """ A seekable raw reader over a memory map, so TextIOWrapper
+    decodes and zipfile reads straight from the mapped pages.
+
+    :params mapped: mmap.mmap, the mapped file
+    """
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._mapped.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._mapped.seek(offset, whence)
+        return self._mapped.tell()
+
+    def tell(self):
+        return self._mapped.tell()
+
+
+def source_for(config):
+    """ The source config.SOURCE names: 'ftp', the FTP server in
+    config.FTP_*, or 'local', the directory config.SOURCE_DIR.
+
+    :params config: module, configuration
+
+    return :: FTPSource or LocalSource
+    """
+    if config.SOURCE == 'ftp':
+        return FTPSource(config)
+    if config.SOURCE == 'local':
+        return LocalSource(config.SOURCE_DIR)
+
+    raise ValueError('Unknown SOURCE {!r}, expected ftp or local'.format(config.SOURCE))
+
+
+def stream_source(source, keyword="vendor", stream=False, workers=1, ledger=None,
+                  processes=None):
+    """ Read the records of every file of a source matching keyword,
+    legacy xlsx files first and then csv files in file-date order.
+
+    With stream=True nothing is buffered: records are decoded as the
+    file is read and a generator of records is returned, to be
+    consumed in batches by sqlite_import.
+
+    With workers > 1 files are read and parsed in parallel (over a
+    pool of FTP connections for an FTPSource), at most `workers` files
+    ahead of the consumer. Records still come out in file-date order.
+    Each worker parses its file in full, so up to `workers` whole
+    files are held in memory even with stream=True; bounded memory
+    needs workers=1.
+
+    With processes, CSV files are parsed in byte ranges on a pool of
+    that many processes (see parse_csv_parallel); FTP files are
+    spooled to disk first.
+
+    With a ledger list, files already in the ingested_files table with
+    the same size and modification time are skipped, and the entries of
+    the new files are appended to the list. Pass it to record_ingested
+    once the records have been imported.
+
+    :params source: FTPSource or LocalSource
+    :params keyword: str, keyword to filter files
+    :params stream: boolean, True = lazy generator; False = list
+    :params workers: int, number of files read in parallel
+    :params ledger: list, collects (name, size, modified) of new files
+    :params processes: int, CSV parsing processes; None = in-process
+
+    return :: list (or generator) of dictionaries containing records
+    """
+    records = _iter_source_records(source, keyword, stream, workers, ledger,
+                                   processes)
+    if stream:
+        return records
+
+    return list(records)
+
+
+def stream_ftp(config, keyword="vendor", stream=False, workers=1, ledger=None,
+               processes=None):
+    """ stream_source over the FTP server in config.FTP_*.
+
+    :params config: module, contains all relevant variables
+
+    return :: list (or generator) of dictionaries containing records
+    """
+    return stream_source(FTPSource(config), keyword, stream, workers, ledger,
+                         processes)
+
+
+def _iter_source_records(source, keyword, stream, workers=1, ledger=None,
+                         processes=None):
+    """ Generator behind stream_source. The source stays open for
+    as long as the generator is being consumed.
+
+    return :: generator of dictionaries
+    """
+    pool = multiprocessing.Pool(processes) if processes else None
+    try:
+        with source:
+            files = _list_files(source.names(), keyword)
+            if ledger is not None:
+                files = _new_files(source, files, ledger)
+            if workers > 1:
+                for records in _pipeline_files(source, files, workers, pool):
+                    for record in records:
+                        yield record
+                return
+            for file in files:
+                print('Processing File: {}'.format(file[1]))
+                for record in source.records(file[1], stream, pool):
+                    yield record
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def _pipeline_files(source, files, workers, parsers=None):
+    """ Read and parse files on a pool of threads, each with its own
+    copy of the source, keeping at most `workers` parsed files in
+    flight (and in memory).
+    Parsed files are yielded in the order given, so the import order
+    is unchanged while file N+1 is read during the parse of file N.
+
+    :params source: FTPSource or LocalSource
+    :params files: list, (sort key, file name) tuples in import order
+    :params workers: int, number of files read in parallel
+    :params parsers: multiprocessing.Pool, CSV parsing processes, or None
+
+    return :: generator of lists of dictionaries, one per file
+    """
+    local = threading.local()
+    copies = []
+    lock = threading.Lock()
+
+    def fetch(name):
+        if not hasattr(local, 'source'):
+            local.source = source.copy()
+            with lock:
+                copies.append(local.source)
+        print('Processing File: {}'.format(name))
+        return list(local.source.records(name, pool=parsers))
+
+    pending = deque()
+    names = iter(file[1] for file in files)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for name in itertools.islice(names, workers):
+                pending.append(pool.submit(fetch, name))
+            while pending:
+                records = pending.popleft().result()
+                name = next(names, None)
+                if name is not None:
+                    pending.append(pool.submit(fetch, name))
+                yield records
+    finally:
+        for future in pending:
+            future.cancel()
+        for copy in copies:
+            if copy is not source:
+                copy.close()
+
+
+def _csv_file_date(name):
+    """ Pull the file date out of a csv file name.
+
+    :params name: str, file name
+
+    return :: str, iso formatted date
+    """
+    return str(datetime.strptime(name.split('_')[1].split('.')[0],
+        '%Y%m%d').date())
+
+
+def _list_files(names, keyword):
+    """ Filter file names on keyword and order them, legacy xlsx
+    files first and then csv files in file-date order.
+
+    :params names: list, file names of a source
+    :params keyword: str, keyword to filter files
+
+    return :: list of (sort key, file name) tuples
+    """
+    preprocess = []
+    csvs = []
+    xlsxs = []
+    for name in names:
+        if ('_' in name or '-' in name) and keyword in name.lower():
+            preprocess.append(name)
+    for file in preprocess:
+        if '_' in file:
+            csvs.append((datetime.strptime(file.split('_')[1].replace('.csv',''),'%Y%m%d').date(), file))
+        else:
+            xlsxs.append((int(file[-9:].replace('.xlsx','')), file))
+    csvs.sort()
+    xlsxs.sort()
+
+    return xlsxs+csvs
+
+
+def _new_files(source, files, ledger):
+    """ Drop the files the ingested_files ledger already holds with
+    the same size and modification time, and collect the ledger
+    entries of the rest. A file the source can give neither a size
+    nor a modification time for is always new.
+
+    :params source: FTPSource or LocalSource
+    :params files: list, (sort key, file name) tuples
+    :params ledger: list, collects (name, size, modified) of new files
+
+    return :: list of (sort key, file name) tuples
+    """
+    seen = {row.name: (row.size, row.modified)
+            for row in models.ingested_files.select()}
+    new = []
+    for file in files:
+        size, modified = source.stat(file[1])
+        if (size, modified) != (None, None) and seen.get(file[1]) == (size, modified):
+            continue
+        ledger.append((file[1], size, modified))
+        new.append(file)
+
+    return new
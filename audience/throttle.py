@@ -0,0 +1,283 @@
+"""
+throttle -- rate limiting and retries for Graph API calls
+"""
+import json
+import time
+import random
+import threading
+
+from requests.exceptions import ConnectionError, Timeout
+from facebookads.exceptions import FacebookRequestError
+
+from .metrics import metrics
+
+# Graph API error codes that mean "slow down" rather than "bad request".
+THROTTLE_CODES = (4, 17, 32, 613) + tuple(range(80000, 80015))
+
+USAGE_HEADERS = ('x-app-usage', 'x-ad-account-usage',
+                 'x-business-use-case-usage')
+USAGE_KEYS = ('call_count', 'total_cputime', 'total_time', 'acc_id_util_pct')
+
+# endpoint -> (smallest, starting, largest) users per call.
+# User add limit is ~10000; user delete limit is 500 < x < 1000.
+BATCH_LIMITS = {'add': (100, 2500, 10000), 'remove': (50, 500, 1000)}
+
+
+class TokenBucket:
+    """ A thread-safe token bucket. Every API call takes one token;
+    tokens refill at `rate` per second up to `capacity`.
+
+    The refill rate follows the Graph API usage headers: it is scaled
+    down as the reported usage approaches 100% and the bucket stops
+    handing out tokens for as long as the API says access is blocked.
+
+    :params rate: float, calls per second at zero usage
+    :params capacity: int, largest burst of calls
+
+    return :: throttle.TokenBucket object
+    """
+
+    def __init__(self, rate=5.0, capacity=1):
+        self._base_rate = float(rate)
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a token is available and take it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens +
+                                   (now - self._stamp) * self._rate)
+                self._stamp = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now,
+                           (1 - self._tokens) / self._rate)
+            time.sleep(wait)
+
+    def update(self, headers):
+        """ Rescale the refill rate from a response's usage headers.
+
+        :params headers: mapping, HTTP response headers
+        """
+        usage, regain = usage_from_headers(headers)
+        with self._lock:
+            self._rate = self._base_rate * max(0.05, 1 - usage / 100.0)
+            if usage >= 100 or regain:
+                self._block(regain * 60 or 60)
+
+    def block(self, seconds):
+        """ Hand out no tokens for the given number of seconds.
+
+        :params seconds: float, seconds to block for
+        """
+        with self._lock:
+            self._block(seconds)
+
+    def _block(self, seconds):
+        self._blocked_until = max(self._blocked_until,
+                                  time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def __str__(self):
+        return '<[TokenBucket Object]>'
+
+    def __repr__(self):
+        return '<TokenBucket Object [{:.2f}/s]>'.format(self._rate)
+
+
+class BatchSizer:
+    """ An additive-increase, multiplicative-decrease controller of
+    users per call, one size per endpoint. A full batch answered
+    within the target latency, without throttling, grows the size by
+    a tenth of its starting value; throttling, a slow answer or a
+    payload the API rejects as too large halves it, once for all the
+    calls cut at the size that failed. Sizes stay within BATCH_LIMITS
+    and can be saved and restored between runs.
+
+    :params target: float, seconds a healthy call takes at most
+    :params limits: dict, endpoint -> (smallest, starting, largest)
+
+    return :: throttle.BatchSizer object
+    """
+
+    def __init__(self, target=5.0, limits=BATCH_LIMITS):
+        self._target = float(target)
+        self._limits = dict(limits)
+        self._sizes = {endpoint: start
+                       for endpoint, (low, start, high) in self._limits.items()}
+        self._lock = threading.Lock()
+
+    def size(self, endpoint):
+        """ Users to send in the next call to an endpoint.
+
+        :params endpoint: str, e.g. 'add' or 'remove'
+        """
+        with self._lock:
+            return self._sizes[endpoint]
+
+    def record(self, endpoint, sent, seconds, throttled=False):
+        """ Adjust an endpoint's size after an answered call.
+
+        :params endpoint: str, e.g. 'add' or 'remove'
+        :params sent: int, users in the call
+        :params seconds: float, time the call took, retries included
+        :params throttled: boolean, the call was throttled on the way
+        """
+        if throttled or seconds > self._target:
+            return self.shrink(endpoint, sent)
+        low, start, high = self._limits[endpoint]
+        with self._lock:
+            if sent >= self._sizes[endpoint]:
+                self._sizes[endpoint] = min(high, self._sizes[endpoint] +
+                                            max(1, start // 10))
+
+    def shrink(self, endpoint, sent=None):
+        """ Halve an endpoint's size. A call larger than the current
+        size was cut before an earlier halving and changes nothing.
+
+        :params endpoint: str, e.g. 'add' or 'remove'
+        :params sent: int, users in the call that failed
+        """
+        low, start, high = self._limits[endpoint]
+        with self._lock:
+            if sent is None or sent <= self._sizes[endpoint]:
+                self._sizes[endpoint] = max(low, self._sizes[endpoint] // 2)
+
+    def restore(self, sizes):
+        """ Take sizes saved from an earlier run, clamped to the limits.
+
+        :params sizes: dict, endpoint -> size
+        """
+        with self._lock:
+            for endpoint, size in sizes.items():
+                if endpoint in self._limits:
+                    low, start, high = self._limits[endpoint]
+                    self._sizes[endpoint] = min(high, max(low, int(size)))
+
+    @property
+    def sizes(self):
+        with self._lock:
+            return dict(self._sizes)
+
+    def __str__(self):
+        return '<[BatchSizer Object]>'
+
+    def __repr__(self):
+        return '<BatchSizer Object [{}]>'.format(self.sizes)
+
+
+def usage_from_headers(headers):
+    """ Read the highest usage percentage and the longest wait
+    out of the Graph API usage headers.
+
+    :params headers: mapping, HTTP response headers
+
+    return :: tuple, (float usage percent, int minutes to regain access)
+    """
+    usage, regain = 0.0, 0
+    lowered = {key.lower(): value for key, value in (headers or {}).items()}
+
+    for name in USAGE_HEADERS:
+        try:
+            body = json.loads(lowered[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+        entries = [body]
+        if name == 'x-business-use-case-usage':
+            entries = [entry for values in body.values() for entry in values]
+        for entry in entries:
+            for key, value in entry.items():
+                if key == 'estimated_time_to_regain_access':
+                    regain = max(regain, int(value or 0))
+                elif key in USAGE_KEYS:
+                    usage = max(usage, float(value or 0))
+
+    return usage, regain
+
+
+def is_throttled(error):
+    """ True when a failed call was refused for going too fast.
+
+    :params error: Exception, raised by the call
+    """
+    return (isinstance(error, FacebookRequestError) and
+            error.api_error_code() in THROTTLE_CODES)
+
+
+def is_oversized(error):
+    """ True when a failed call was refused for carrying too much.
+
+    :params error: Exception, raised by the call
+    """
+    if not isinstance(error, FacebookRequestError):
+        return False
+    message = (error.api_error_message() or '').lower()
+    return (error.http_status() == 413 or 'too large' in message or
+            'too many' in message)
+
+
+def is_retryable(error):
+    """ True when a failed call is worth retrying: throttling,
+    transient API errors, server errors and dropped connections.
+
+    :params error: Exception, raised by the call
+    """
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    if isinstance(error, FacebookRequestError):
+        return (is_throttled(error) or
+                bool(error.api_transient_error()) or
+                (error.http_status() or 0) >= 500)
+    return False
+
+
+def call_with_retry(call, bucket=None, retries=5, base=1.0, cap=60.0,
+                    on_error=None):
+    """ Make an API call through a token bucket, retrying retryable
+    failures with exponential backoff and full jitter.
+
+    :params call: callable, makes one API call and returns its response
+    :params bucket: throttle.TokenBucket, optional rate limiter
+    :params retries: int, attempts after the first one
+    :params base: float, first backoff ceiling in seconds
+    :params cap: float, largest backoff ceiling in seconds
+    :params on_error: callable, told of every failure before it is
+    retried or raised
+
+    return :: the call's response
+    """
+    for attempt in range(retries + 1):
+        if bucket:
+            bucket.acquire()
+        try:
+            response = call()
+        except Exception as error:
+            if on_error:
+                on_error(error)
+            if attempt == retries or not is_retryable(error):
+                raise
+            delay = random.uniform(0, min(cap, base * 2 ** attempt))
+            reason = error
+            if isinstance(error, FacebookRequestError):
+                reason = error.api_error_message()
+                if bucket:
+                    bucket.update(error.http_headers())
+            print('Retrying in {:.1f}s after: {}'.format(delay, reason))
+            metrics.count('api_retries')
+            time.sleep(delay)
+            continue
+        if bucket:
+            bucket.update(response.headers())
+        return response
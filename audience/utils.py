@@ -1,25 +1,94 @@
 from . import models 
+from .metrics import metrics
 
 import io
 import os
+import csv
+import bisect
 import ftplib
+import hashlib
+import itertools
+import mmap
+import multiprocessing
+import sqlite3
 import subprocess
+import tempfile
 
+from collections import deque
+from contextlib import contextmanager
 from openpyxl import load_workbook
+from openpyxl.xml.constants import SHEET_MAIN_NS
+from xml.etree.ElementTree import iterparse
 from datetime import datetime, timedelta, date
 
+try:
+	import numpy
+except ImportError:
+	numpy = None  # segment_records falls back to bisecting row by row.
+
+SEGMENTS = ('current', 'lapsed', 'extra lapsed')  # default tiers, most recent first
+SEGMENT_DAYS = (90, 730)  # days since the last order where each later tier begins
+SEGMENT_BLOCK = 10000  # records segmented per vectorized pass while streaming
+HASH_BLOCK = 10000  # records hashed per pass by sqlite_import
+PARSE_RANGE = 2 ** 22  # bytes of csv per task when parsing on a process pool
+BULK_ROWS_PER_STATEMENT = 256  # rows per multi-row INSERT in bulk mode
+BULK_PRAGMAS = (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+				('cache_size', -262144), ('mmap_size', 2 ** 30))  # 256MB cache, 1GB map
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d')  # order date layouts, most common first
+DATE_MEMO = 65536  # distinct date strings remembered per DateParser
+NAT = -2 ** 63  # int64 value of numpy.datetime64('NaT'); numpy.isnat needs numpy 1.13
+SHEET_DATA_TAG = '{%s}sheetData' % SHEET_MAIN_NS
+ROW_TAG = '{%s}row' % SHEET_MAIN_NS
+
 
 def write_database(config):
 	""" Write the customer datbase using a sql schema file.
-	If database exists, do nothing.
+	If database exists, only bring its schema up to date. Segments
+	are assigned from the configuration's tiers from here on.
 	
 	:params config: config module, application configuration module
 	"""
+	models.use(config.DATABASE_PATH)
+	tiers.configure(config.SEGMENTS, config.SEGMENT_DAYS)
 	if not os.path.isfile(config.DATABASE_PATH):
 		file = open(config.DATABASE_PATH, 'w')
 		file.close()
 		database, schema = config.DATABASE_PATH, config.DATABASE_SCHEMA
 		subprocess.call('sqlite3 "{}" < "{}"'.format(database, schema), shell=True)
+	models.migrate()
+	_backfill_email_hashes(config.HASH_PROCESSES)
+
+
+def _backfill_email_hashes(processes=None):
+	""" Fill email_hash for records imported before the column existed,
+	HASH_BLOCK records at a time and across `processes` worker
+	processes when given.
+
+	:params processes: int, hashing processes; None hashes in-process
+	"""
+	table = models.customers
+	query = (table.select(table.sell_to_customer_no_, table.usa_email)
+			 .where(table.email_hash >> None, table.usa_email.is_null(False)))
+	if not query.exists():
+		return
+
+	pool = multiprocessing.Pool(processes) if processes else None
+	try:
+		with models.database.atomic():
+			cursor = models.database.execute_sql(*query.sql())
+			rows = cursor.fetchmany(HASH_BLOCK)
+			while rows:
+				records = hash_records([{'sell_to_customer_no_': key, 'usa_email': email}
+										for key, email in rows], pool)
+				models.database.get_cursor().executemany(
+					'UPDATE customers SET email_hash = ? WHERE sell_to_customer_no_ = ?',
+					[(record['email_hash'], record['sell_to_customer_no_'])
+					 for record in records])
+				rows = cursor.fetchmany(HASH_BLOCK)
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
 
 
 def process_csv_bytestring(file_object, file_date=None):
@@ -31,44 +100,340 @@ def process_csv_bytestring(file_object, file_date=None):
 
 	return :: list of dictionaries
 	"""
-	store = []
-	headers = []
-	_str = str(file_object.getvalue()).split('\\r\\n')
-	parse_out = ('b"', ' ', '-', "\\xef\\xbb\\xbf")
-		
-	for header in _str[0].split(','):
-		parsed = header
-		for char in parse_out:
-			if char in (' ', '-'):
-				parsed = parsed.replace(char, '_')
-			else:
-				parsed = parsed.replace(char, '')
-		headers.append(parsed.lower())
-	
-	for item in _str[1:]:
-		record = item.split(',')
-		if len(record) == len(headers):
-			record = dict(zip(headers, record))
+	file_object.seek(0)
+	text = io.TextIOWrapper(file_object, encoding='utf-8-sig',
+							errors='replace', newline='')
+	try:
+		return list(iter_csv_records(text, file_date))
+	finally:
+		text.detach()
+
+
+def iter_csv_records(lines, file_date=None):
+	""" Lazily decode an iterable of CSV text lines into
+	import-ready dictionaries, one record at a time.
+
+	:params lines: iterable, text lines (file object, socket reader, list)
+	:params file_date: str, date in file
+
+	return :: generator of dictionaries
+	"""
+	reader = csv.reader(lines)
+	headers = [_clean_header(header) for header in next(reader, [])]
+	dates = DateParser()
+	records = (_prepare_csv_record(dict(zip(headers, row)), file_date, dates)
+			   for row in reader if len(row) == len(headers))
+
+	for block in data_generator(records, SEGMENT_BLOCK):
+		for record in segment_records(block):
+			yield record
+
+
+def stream_csv(ftp, name, file_date=None):
+	""" Stream a CSV file straight off the FTP data socket and
+	yield import-ready records as they are decoded. Only the
+	socket buffer and the current row are held in memory.
+
+	:params ftp: ftplib.FTP, logged in connection
+	:params name: str, file name on the server
+	:params file_date: str, date in file
+
+	return :: generator of dictionaries
+	"""
+	ftp.voidcmd('TYPE I')
+	conn = ftp.transfercmd('RETR {}'.format(name))
+	raw = _CountingReader(conn.makefile('rb'))
+	text = io.TextIOWrapper(io.BufferedReader(raw), encoding='utf-8-sig',
+							errors='replace', newline='')
+	complete = False
+	try:
+		for record in iter_csv_records(text, file_date):
+			yield record
+		complete = True
+	finally:
+		text.close()
+		conn.close()
+		metrics.count('bytes_downloaded', raw.bytes_read)
+		metrics.count('files_downloaded')
+		try:
+			ftp.voidresp()  # 226, or 426 when the transfer was cut short
+		except (ftplib.error_temp, ftplib.error_perm):
+			if complete:
+				raise
+
+
+def stream_csv_parallel(ftp, name, file_date, pool):
+	""" Spool a CSV file from the FTP server to a named temp file and
+	parse it on a process pool with parse_csv_parallel.
+
+	:params ftp: ftplib.FTP, logged in connection
+	:params name: str, file name on the server
+	:params file_date: str, date in file
+	:params pool: multiprocessing.Pool, parsing processes
+
+	return :: generator of dictionaries
+	"""
+	with tempfile.NamedTemporaryFile(prefix='audience-', suffix='.csv') as spool:
+		ftp.retrbinary('RETR {}'.format(name), spool.write)
+		spool.flush()
+		metrics.count('bytes_downloaded', spool.tell())
+		metrics.count('files_downloaded')
+		for record in parse_csv_parallel(spool.name, file_date, pool):
+			yield record
+
+
+def parse_csv_parallel(path, file_date, pool):
+	""" Parse a CSV file on disk on a process pool. The file is
+	memory-mapped and split at line boundaries into byte ranges of
+	about PARSE_RANGE bytes; every process maps the file itself and
+	parses whole ranges, so only the records travel back. At most two
+	ranges per process are in flight and records come out in file
+	order. Quoted fields must not span lines.
+
+	:params path: str, CSV file
+	:params file_date: str, date in file
+	:params pool: multiprocessing.Pool, parsing processes
+
+	return :: generator of dictionaries
+	"""
+	if not os.path.getsize(path):
+		return
+	with open(path, 'rb') as handle, \
+			mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+		start = _line_end(mapped, 0)
+		header = mapped[:start].decode('utf-8-sig', errors='replace')
+		headers = [_clean_header(column) for column in next(csv.reader([header]), [])]
+		ranges = _byte_ranges(mapped, start, PARSE_RANGE)
+
+	args = (path, headers, file_date, tiers.names, tiers.days)
+	pending = deque(pool.apply_async(_parse_csv_range, span + args)
+					for span in itertools.islice(ranges, 2 * pool._processes))
+	while pending:
+		records = pending.popleft().get()
+		span = next(ranges, None)
+		if span is not None:
+			pending.append(pool.apply_async(_parse_csv_range, span + args))
+		metrics.count('csv_ranges_parsed')
+		for record in records:
+			yield record
+
+
+def _line_end(mapped, position):
+	""" The offset just past the line holding `position`.
+
+	:params mapped: mmap.mmap, file contents
+	:params position: int, byte offset
+	"""
+	end = mapped.find(b'\n', position)
+
+	return len(mapped) if end < 0 else end + 1
+
+
+def _byte_ranges(mapped, start, size):
+	""" Split a mapped file from `start` into (start, end) byte ranges
+	of about `size` bytes, each ending at a line boundary. Computed up
+	front so the map can be closed.
+
+	:params mapped: mmap.mmap, file contents
+	:params start: int, first byte (past the header line)
+	:params size: int, target range size
+
+	return :: iterator of tuples
+	"""
+	ranges = []
+	while start < len(mapped):
+		end = _line_end(mapped, min(len(mapped), start + size) - 1)
+		ranges.append((start, end))
+		start = end
+
+	return iter(ranges)
+
+
+def _parse_csv_range(start, end, path, headers, file_date, names, days):
+	""" Parse one byte range of a CSV file into import-ready records.
+	Runs in a pool process; the tiers are passed in so segments match
+	the parent's whatever the start method.
+
+	:params start: int, first byte, at a line start
+	:params end: int, byte past the last line
+	:params path: str, CSV file
+	:params headers: list, column names
+	:params file_date: str, date in file
+	:params names: tuple, tier segment names
+	:params days: tuple, tier thresholds
+
+	return :: list of dictionaries
+	"""
+	tiers.configure(names, days)
+	with open(path, 'rb') as handle, \
+			mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+		text = mapped[start:end].decode('utf-8', errors='replace')
+	rows = csv.reader(io.StringIO(text, newline=''))
+	dates = DateParser()
+	records = [_prepare_csv_record(dict(zip(headers, row)), file_date, dates)
+			   for row in rows if len(row) == len(headers)]
+
+	return segment_records(records)
+
+
+class _CountingReader(io.RawIOBase):
+	""" A raw reader that counts the bytes read through it.
+
+	:params raw: binary file object, e.g. a socket makefile
+	"""
+
+	def __init__(self, raw):
+		self._raw = raw
+		self.bytes_read = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		size = self._raw.readinto(buffer)
+		self.bytes_read += size or 0
+		return size
+
+	def close(self):
+		self._raw.close()
+		super().close()
+
+
+def _clean_header(header):
+	""" Normalize a raw CSV header into a column name.
+
+	:params header: str, raw header
+
+	return :: str, column name
+	"""
+	return header.strip().replace(' ', '_').replace('-', '_').lower()
+
+
+class DateParser:
+	""" Parses the order dates of one file. The layout is detected
+	from the first date and then read by slicing fixed positions,
+	falling back to detection (and strptime for layouts without a
+	fast path) only when a value does not fit. Order dates take a
+	few thousand distinct values, so every string is parsed once and
+	remembered, up to DATE_MEMO of them.
+
+	:params formats: tuple, strptime layouts to detect, in order
+
+	return :: utils.DateParser object
+	"""
+
+	def __init__(self, formats=DATE_FORMATS):
+		self._formats = formats
+		self._layout = None
+		self._dates = {}
+		self._isoformats = {}
+		self.today = date.today().isoformat()
+
+	def date(self, value):
+		""" The datetime.date of a date string (or date, datetime).
+
+		:params value: str, datetime.date or datetime.datetime
+		"""
+		if isinstance(value, datetime):
+			return value.date()
+		if isinstance(value, date):
+			return value
+		try:
+			return self._dates[value]
+		except KeyError:
+			parsed = self._parse(value)
+		if len(self._dates) < DATE_MEMO:
+			self._dates[value] = parsed
+
+		return parsed
+
+	def isoformat(self, value):
+		""" The ISO string of a date string (or date, datetime).
+
+		:params value: str, datetime.date or datetime.datetime
+		"""
+		try:
+			return self._isoformats[value]
+		except KeyError:
+			parsed = self.date(value).isoformat()
+		if len(self._isoformats) < DATE_MEMO:
+			self._isoformats[value] = parsed
+
+		return parsed
+
+	def _parse(self, value):
+		if self._layout is not None:
 			try:
-				order_date = datetime.strptime(record['last_order_date'],
-											   '%m/%d/%Y').date()
+				return self._layout(value)
 			except ValueError:
-				order_date = datetime.strptime(record['last_order_date'],
-											   '%Y-%m-%d').date()
-			record['last_order_date'] = order_date.isoformat()
-			record['segment'] = return_segment(order_date)
-			record['record_create_date'] = date.today().isoformat()
-			record['file_parse_date'] = file_date
-			if len(record) > 11:
-				del record['address_2']
-				del record['address_1']
-				del record['state']
-				del record['post_code']
-				del record['country']
-				del record['city']
-			store.append(record)
-
-	return store
+				pass
+		for layout in self._formats:
+			reader = _DATE_LAYOUTS.get(layout) or _strptime_date(layout)
+			try:
+				parsed = reader(value)
+			except ValueError:
+				continue
+			self._layout = reader
+			return parsed
+
+		raise ValueError('Unrecognized date {!r}, expected one of {}'.format(
+			value, self._formats))
+
+	def __str__(self):
+		return '<[DateParser Object]>'
+
+	def __repr__(self):
+		return '<DateParser Object [{} dates]>'.format(len(self._dates))
+
+
+def _us_date(value):
+	""" Fast path for '%m/%d/%Y' (leading zeros optional).
+	"""
+	month, day, year = value.split('/')
+	if len(year) != 4:
+		raise ValueError(value)
+
+	return date(int(year), int(month), int(day))
+
+
+def _iso_date(value):
+	""" Fast path for '%Y-%m-%d' (leading zeros optional).
+	"""
+	year, month, day = value.split('-')
+	if len(year) != 4:
+		raise ValueError(value)
+
+	return date(int(year), int(month), int(day))
+
+
+def _strptime_date(layout):
+	""" A reader for a layout without a fast path.
+	"""
+	return lambda value: datetime.strptime(value, layout).date()
+
+
+_DATE_LAYOUTS = {'%m/%d/%Y': _us_date, '%Y-%m-%d': _iso_date}
+
+
+def _prepare_csv_record(record, file_date, dates=None):
+	""" Parse dates and strip address columns from a raw CSV
+	record. The segment is assigned per block by segment_records.
+
+	:params record: dict, raw record keyed on column name
+	:params file_date: str, date in file
+	:params dates: DateParser, the file's date parser
+
+	return :: dict, import-ready record
+	"""
+	dates = dates or DateParser()
+	record['last_order_date'] = dates.isoformat(record['last_order_date'])
+	record['record_create_date'] = dates.today
+	record['file_parse_date'] = file_date
+	for column in ('address_2', 'address_1', 'state',
+				   'post_code', 'country', 'city'):
+		record.pop(column, None)
+
+	return record
 
 
 def process_xlsx_bytestring(file_obj):
@@ -79,65 +444,216 @@ def process_xlsx_bytestring(file_obj):
 
 	return :: list of dictionaries
 	"""
-	store = []
+	return list(iter_xlsx_records(file_obj))
+
+
+def iter_xlsx_records(file_obj):
+	""" Lazily read the rows of 'Sheet1' into import-ready
+	dictionaries. The workbook is opened read-only and rows are
+	pulled from the worksheet XML one at a time, so only the current
+	block of SEGMENT_BLOCK records is held in memory.
+
+	:params file_obj: seekable binary file object (BytesIO, temp file)
+
+	return :: generator of dictionaries
+	"""
 	wb = load_workbook(filename=file_obj, read_only=True)
-	data = [[cell.value for cell in r] for r in wb['Sheet1'].rows]
+	rows = _iter_sheet_rows(wb['Sheet1'])
 	headers = [header.replace('-', '_').replace(' ', '_').lower()
-			  for header in data[0]]
+			  for header in next(rows, [])]
+	padding = [None] * len(headers)
+	dates = DateParser()
+	records = (_prepare_xlsx_record(dict(zip(headers, row + padding)), dates)
+			   for row in rows)
+	records = (record for record in records if record is not None)
+
+	for block in data_generator(records, SEGMENT_BLOCK):
+		for record in segment_records(block):
+			yield record
+
 
-	for row in data[1:]:
-		record = dict(zip(headers, row))
-		if record['last_order_date'] is None:
+def stream_xlsx(ftp, name):
+	""" Spool an XLSX file from the FTP server to an anonymous temp
+	file (an xlsx is a zip archive and needs random access) and yield
+	import-ready records as its rows are read.
+
+	:params ftp: ftplib.FTP, logged in connection
+	:params name: str, file name on the server
+
+	return :: generator of dictionaries
+	"""
+	with tempfile.TemporaryFile(prefix='audience-', suffix='.xlsx') as spool:
+		ftp.retrbinary('RETR {}'.format(name), spool.write)
+		metrics.count('bytes_downloaded', spool.tell())
+		metrics.count('files_downloaded')
+		spool.seek(0)
+		for record in iter_xlsx_records(spool):
+			yield record
+
+
+def _iter_sheet_rows(ws):
+	""" Yield the cell values of each row of a read-only worksheet.
+	openpyxl's iter_rows clears parsed rows but leaves them attached
+	to sheetData, so the tree grows with the sheet; here every row is
+	dropped from the tree once its values are read. The shared string
+	table is still loaded whole by load_workbook.
+
+	:params ws: openpyxl read-only worksheet
+
+	return :: generator of lists
+	"""
+	sheet_data = None
+	for event, element in iterparse(ws.xml_source, events=('start', 'end')):
+		if event == 'start':
+			if element.tag == SHEET_DATA_TAG:
+				sheet_data = element
 			continue
-		record['last_order_date'] = record['last_order_date'].date()
-		record['segment'] = return_segment(record['last_order_date'])
-		record['record_create_date'] = date.today()
-		record['file_parse_date'] = '1900-01-01' # Arbitrary old date.
-		store.append(record)
-
-	return store
-
-
-def stream_ftp(config, keyword="vendor"):
-	""" Connect to specified FTP server, stream file(s) into
-	file-like objects and return a list or single file-like object.
-
-	:params config: module, contains all relevant variables
-	:params keyword: str, keyword to filter files
-
-	return :: list of dictionaries containing records
-	"""
-	store = []
-	preprocess = []
-	csvs = []
-	xlsxs = []
-	with ftplib.FTP(config.FTP_HOST) as ftp:
-		ftp.login(config.FTP_USER, config.FTP_PASSWORD)
-		ftp.cwd(config.FTP_DIR)
-		for name in ftp.nlst(): 
-			if ('_' in name or '-' in name) and keyword in name.lower():
-				preprocess.append(name)
-		for file in preprocess:
-			if '_' in file:
-				csvs.append((datetime.strptime(file.split('_')[1].replace('.csv',''),'%Y%m%d').date(), file))
-			else:
-				xlsxs.append((int(file[-9:].replace('.xlsx','')), file))
-		csvs.sort()
-		xlsxs.sort()
-		files = xlsxs+csvs
-		for file in files:
-			print('Processing File: {}'.format(file[1]))
-			file_obj = io.BytesIO()
-			ftp.retrbinary('RETR {}'.format(file[1]), file_obj.write)
-			if 'xlsx' in file[1]:
-				store.extend(process_xlsx_bytestring(file_obj))
-			else:
-				filedate = str(datetime.strptime(file[1].split('_')[1].split('.')[0],
-                    '%Y%m%d').date())
-				store.extend(process_csv_bytestring(file_obj, filedate))
-	ftp.close()
-
-	return store
+		if element.tag == ROW_TAG:
+			yield [cell.value for cell in ws._get_row(element)]
+			sheet_data.clear()
+
+
+def _prepare_xlsx_record(record, dates=None):
+	""" Convert the dates of a raw XLSX record. Rows without an
+	order date are dropped. Dates are usually datetime cells; text
+	cells go through the date parser.
+
+	:params record: dict, raw record keyed on column name
+	:params dates: DateParser, the file's date parser
+
+	return :: dict, import-ready record or None
+	"""
+	if record.get('last_order_date') is None:
+		return None
+	dates = dates or DateParser()
+	record['last_order_date'] = dates.isoformat(record['last_order_date'])
+	record['record_create_date'] = dates.today
+	record['file_parse_date'] = '1900-01-01' # Arbitrary old date.
+
+	return record
+
+
+def record_ingested(ledger):
+	""" Write ledger entries collected by stream_source into the
+	ingested_files table, replacing older entries by name.
+
+	:params ledger: list, (name, size, modified) tuples
+	"""
+	today = date.today().isoformat()
+	rows = [{'name': name, 'size': size, 'modified': modified,
+			 'ingest_date': today} for name, size, modified in ledger]
+
+	with models.database.atomic():
+		for chunk in data_generator(rows):
+			models.ingested_files.insert_many(chunk).upsert(True).execute()
+
+
+class Tiers:
+	""" Recency tiers: segment names from the most recent orders to
+	the oldest and the day thresholds between them. A last order date
+	falls in a tier by binary search over the sorted cutoff dates;
+	missing dates, and dates from today on, fall in none.
+
+	:params names: sequence, segment names, most recent first
+	:params days: sequence, ascending days since the last order at
+	which each tier after the first begins; one fewer than names
+
+	return :: utils.Tiers object
+	"""
+
+	def __init__(self, names=SEGMENTS, days=SEGMENT_DAYS):
+		self.configure(names, days)
+
+	def configure(self, names=SEGMENTS, days=SEGMENT_DAYS):
+		""" (Re)set the tiers.
+
+		:params names: sequence, segment names, most recent first
+		:params days: sequence, ascending day thresholds
+		"""
+		names, days = tuple(names), tuple(int(day) for day in days)
+		if len(names) != len(days) + 1 or len(set(names)) != len(names):
+			raise ValueError('Expected {} distinct segment names for {} thresholds, '
+							 'got {}.'.format(len(days) + 1, len(days), names))
+		if any(day <= 0 for day in days) or list(days) != sorted(set(days)):
+			raise ValueError('Segment thresholds must be positive and ascending, '
+							 'got {}.'.format(days))
+		self.names, self.days = names, days
+
+	def cutoffs(self, today=None):
+		""" The date each tier begins at, newest first.
+
+		:params today: datetime.date, defaults to today
+
+		return :: tuple, (today, one date per threshold)
+		"""
+		_today = today or date.today()
+
+		return (_today,) + tuple(_today - timedelta(days=day) for day in self.days)
+
+	def classify(self, dates, today=None):
+		""" The segment of every date of a column, by bisection.
+
+		:params dates: iterable, datetime.date or None
+		:params today: datetime.date, defaults to today
+
+		return :: list of str (None outside every tier)
+		"""
+		bounds = self.cutoffs(today)[::-1]
+		lookup = self.names[::-1] + (None,)
+
+		return [None if order_date is None else
+				lookup[bisect.bisect_right(bounds, order_date)]
+				for order_date in dates]
+
+	def case(self, column, today=None):
+		""" A SQL CASE expression giving the segment of an ISO date
+		column, as classify does.
+
+		:params column: str, column name
+		:params today: datetime.date, defaults to today
+
+		return :: tuple, (str SQL, list of parameters)
+		"""
+		_today, *cutoffs = (cutoff.isoformat() for cutoff in self.cutoffs(today))
+		sql = ['CASE WHEN {0} IS NULL OR {0} >= ? THEN NULL']
+		params = [_today]
+		for name, cutoff in zip(self.names, cutoffs):
+			sql.append('WHEN {0} >= ? THEN ?')
+			params.extend((cutoff, name))
+		sql.append('ELSE ? END')
+		params.append(self.names[-1])
+
+		return ' '.join(sql).format(column), params
+
+	def aged(self, segment, column, today=None):
+		""" A SQL condition matching the records whose last order has
+		aged past the end of their segment. Every term is a range on
+		the (segment, last_order_date) index.
+
+		:params segment: str, segment column name
+		:params column: str, last order date column name
+		:params today: datetime.date, defaults to today
+
+		return :: tuple, (str SQL, list of parameters)
+		"""
+		cutoffs = self.cutoffs(today)[1:]
+		terms = ['({} = ? AND {} < ?)'.format(segment, column)] * len(cutoffs)
+		params = [value for name, cutoff in zip(self.names, cutoffs)
+				  for value in (name, cutoff.isoformat())]
+
+		return ' OR '.join(terms) or '0', params
+
+	def __str__(self):
+		return '<[Tiers Object]>'
+
+	def __repr__(self):
+		return '<Tiers Object [{}]>'.format(', '.join(
+			'{} from {}d'.format(name, day)
+			for name, day in zip(self.names, (0,) + self.days)))
+
+
+tiers = Tiers()
+_iso_dates = DateParser(('%Y-%m-%d',))  # the ISO dates of imported records
 
 
 def return_segment(file_date):
@@ -148,31 +664,424 @@ def return_segment(file_date):
 
 	return :: str, segment
 	"""
-	_today = date.today()
-	_90_days = _today - timedelta(days=90)
-	_2_years = _today - timedelta(days=730)
+	return tiers.classify([file_date])[0]
+
+
+def segment_dates(dates, today=None):
+	""" Vectorized return_segment. Converts a column of last order
+	dates (datetime.date or ISO strings) into a datetime64 array and
+	classifies every date in one pass with searchsorted over the
+	tier cutoffs. Missing dates get None.
 
-	if file_date < _today and file_date >= _90_days:
-		return 'current'
-	if file_date < _90_days and file_date >= _2_years:
-		return 'lapsed'
-	if file_date < _2_years:
-		return 'extra lapsed'
+	Order dates take a few thousand distinct values, so only values
+	not seen before are parsed into datetime64 (see _day_numbers).
 
+	:params dates: sequence, last order dates
+	:params today: datetime.date, defaults to today
 
-def sqlite_import(table, data):
+	return :: numpy.ndarray of str (object dtype)
+	"""
+	bounds = numpy.array(tiers.cutoffs(today)[::-1], dtype='datetime64[D]')
+	lookup = numpy.array(tiers.names[::-1] + (None,), dtype=object)
+	days = _day_numbers(dates)
+	index = numpy.searchsorted(bounds, days.view('datetime64[D]'), side='right')
+	index[days == NAT] = len(bounds)
+
+	return lookup[index]
+
+
+_days = {None: NAT}  # date value -> int64 day number, NAT for missing
+
+
+def _day_numbers(dates):
+	""" The int64 day numbers of a column of dates. Distinct values
+	not met before are parsed in one numpy call and remembered (up to
+	DATE_MEMO of them); every row is then a dictionary lookup.
+
+	:params dates: sequence, dates (datetime.date, ISO strings or None)
+
+	return :: numpy.ndarray of int64
+	"""
+	new = list(set(dates).difference(_days))
+	if new:
+		if len(_days) + len(new) > DATE_MEMO:
+			_days.clear()
+			_days[None] = NAT
+		_days.update(zip(new, numpy.array(new, dtype='datetime64[D]')
+						 .view('int64').tolist()))
+
+	return numpy.fromiter(map(_days.__getitem__, dates), dtype='int64',
+						  count=len(dates))
+
+
+def segment_records(records, today=None):
+	""" Assign the 'segment' key of a block of records from their
+	'last_order_date', vectorized when numpy is installed.
+
+	:params records: list, list of dictionaries
+	:params today: datetime.date, defaults to today
+
+	return :: list, the same records
+	"""
+	if numpy is None:
+		dates = [None if record['last_order_date'] is None else
+				 _iso_dates.date(record['last_order_date']) for record in records]
+		for record, segment in zip(records, tiers.classify(dates, today)):
+			record['segment'] = segment
+		return records
+
+	segments = segment_dates([record['last_order_date'] for record in records],
+							 today)
+	for record, segment in zip(records, segments):
+		record['segment'] = segment
+
+	return records
+
+
+def sqlite_import(table, data, processes=None, bulk=False, drop_indexes=None):
 	""" Performs a REPLACE INTO or UPSERT given a table
 	and list of dictionaries.
 
+	For tables with an email_hash column the emails are normalized
+	and hashed here, once, HASH_BLOCK records at a time and across
+	`processes` worker processes when given.
+
+	With bulk=True peewee is bypassed: rows go through raw executemany
+	on one prepared multi-row statement sized to the connection's
+	variable limit, under the BULK_PRAGMAS load settings. Secondary
+	indexes are dropped for the load and rebuilt after it, by default
+	only when the table starts out empty (build, rebuild).
+
 	:params table: str, name of table in database
-	:params data: list, list of dictionaries containing records to be "pushed"
+	:params data: iterable, list or generator of dictionaries containing
+	records to be "pushed"
+	:params processes: int, hashing processes; None hashes in-process
+	:params bulk: boolean, use the bulk loader
+	:params drop_indexes: boolean, rebuild indexes around a bulk load;
+	None = only into an empty table
 	"""
 	model = models.__dict__[table]
-	record_sets = data_generator(data)  # SQLite has SQL variable limits (999).
+	hashed = 'email_hash' in model._meta.fields
+	pool = multiprocessing.Pool(processes) if hashed and processes else None
+	blocks = _hashed_blocks(data, pool if hashed else False)
+
+	try:
+		if bulk:
+			_bulk_import(model, blocks, drop_indexes)
+			return
+		# One row binds a variable per column; stay under SQLite's limit.
+		rows = max(1, max_variables(model._meta.database) // len(model._meta.fields))
+		with model._meta.database.atomic():
+			for block in blocks:
+				for chunk in data_generator(block, rows):
+					with metrics.timer('db_batch_seconds', table=table):
+						model.insert_many(chunk, validate_fields=True).upsert(True).on_conflict(action='IGNORE').execute()
+				metrics.count('rows_imported', len(block))
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+
+def _hashed_blocks(data, pool):
+	""" Chunk records into HASH_BLOCK lists, hashing their emails.
+
+	:params data: iterable, dictionaries
+	:params pool: multiprocessing.Pool, None hashes in-process and
+	False skips hashing
+
+	return :: generator of lists of dictionaries
+	"""
+	for block in data_generator(data, HASH_BLOCK):
+		if pool is not False:
+			with metrics.timer('hash_block_seconds'):
+				hash_records(block, pool)
+		yield block
+
+
+def _bulk_import(model, blocks, drop_indexes=None):
+	""" Load blocks of records with raw executemany, all inside one
+	transaction. Same INSERT OR REPLACE semantics as the peewee path.
+
+	:params model: peewee.Model, target table
+	:params blocks: iterable, lists of dictionaries
+	:params drop_indexes: boolean, rebuild secondary indexes after
+	the load; None = only into an empty table
+	"""
+	database = model._meta.database
+	table = model._meta.db_table
+	columns = [field.db_column for field in model._meta.sorted_fields]
+	write = _block_writer(database, table, columns)
+
+	if drop_indexes is None:
+		drop_indexes = database.execute_sql(
+			'SELECT 1 FROM {} LIMIT 1'.format(table)).fetchone() is None
 
-	with model._meta.database.atomic():
-		for chunk in record_sets:
-			model.insert_many(chunk, validate_fields=True).upsert(True).on_conflict(action='IGNORE').execute()
+	with bulk_pragmas(database):
+		if drop_indexes:
+			models.drop_indexes(table)
+		try:
+			with database.atomic():
+				for block in blocks:
+					with metrics.timer('db_batch_seconds', table=table):
+						write(block)
+					metrics.count('rows_imported', len(block))
+		finally:
+			if drop_indexes:
+				with metrics.timer('index_rebuild_seconds', table=table):
+					models.create_indexes(table)
+
+
+def _block_writer(database, table, columns):
+	""" Build a function writing a block of records into a table
+	with raw executemany. Rows are packed BULK_ROWS_PER_STATEMENT (at
+	most the variable limit allows) to a prepared statement; the rest
+	of each block goes through the single-row statement.
+
+	:params database: peewee.SqliteDatabase
+	:params table: str, name of table
+	:params columns: list, column names
+
+	return :: function, write(block)
+	"""
+	per_statement = max(1, min(BULK_ROWS_PER_STATEMENT,
+							   max_variables(database) // len(columns)))
+	single = _insert_statement(table, columns, 1)
+	multi = _insert_statement(table, columns, per_statement)
+	width = len(columns) * per_statement
+
+	def write(block):
+		cursor = database.get_cursor()
+		values = [record.get(column) for record in block for column in columns]
+		whole = len(block) // per_statement * width
+		cursor.executemany(multi, (values[start:start + width]
+								   for start in range(0, whole, width)))
+		cursor.executemany(single, (values[start:start + len(columns)]
+									for start in range(whole, len(values), len(columns))))
+
+	return write
+
+
+def sqlite_merge(table, data, processes=None):
+	""" Merge records into a table through a staging table and
+	return what changed for the audiences.
+
+	Every HASH_BLOCK block is loaded into a temp staging table and
+	reconciled in set-based SQL: new keys are inserted and existing
+	ones overwritten, the last record for a key winning. The state a
+	key had before the merge is kept in a second temp table, so the
+	change set comes from the merged keys alone, with no scan of the
+	whole table:
+
+		::::> a new key is added to its segment
+		::::> a key whose segment or email changed is removed from
+		      the old segment and added to the new one
+		::::> an unchanged key is left alone
+
+	:params table: str, name of table in database
+	:params data: iterable, list or generator of dictionaries
+	:params processes: int, hashing processes; None hashes in-process
+
+	return :: dict, {segment: {'add': [email hashes], 'remove': [email hashes]}}
+	"""
+	merge = _Merge(models.__dict__[table])
+	pool = multiprocessing.Pool(processes) if processes else None
+
+	try:
+		with merge.database.atomic():
+			merge.begin()
+			for block in _hashed_blocks(data, pool):
+				merge.block(block)
+			changes = merge.changes()
+			merge.end()
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+	return changes
+
+
+def merge_block(table, block):
+	""" Merge one block of hashed records in its own transaction and
+	return its change set, relative to the table as it was before
+	the block. Applied in order, the change sets of consecutive
+	blocks add up to the change set of sqlite_merge.
+
+	:params table: str, name of table in database
+	:params block: list, dictionaries with email_hash set
+
+	return :: dict, {segment: {'add': [email hashes], 'remove': [email hashes]}}
+	"""
+	merge = _Merge(models.__dict__[table])
+	with merge.database.atomic():
+		merge.begin()
+		merge.block(block)
+		changes = merge.changes()
+		merge.end()
+
+	return changes
+
+
+class _Merge:
+	""" The staging and before-state temp tables of one merge.
+
+	:params model: peewee.Model, target table
+	"""
+
+	def __init__(self, model):
+		self.database = model._meta.database
+		self.table = model._meta.db_table
+		self.key = model._meta.primary_key.db_column
+		self.columns = [field.db_column for field in model._meta.sorted_fields]
+		self.names = ', '.join('"{}"'.format(column) for column in self.columns)
+
+	def begin(self):
+		# Take the write lock before reading: a transaction that reads
+		# first fails at once, without waiting, when another connection
+		# commits before its first write.
+		self.database.execute_sql('DELETE FROM {} WHERE 0'.format(self.table))
+		self.database.execute_sql('DROP TABLE IF EXISTS temp.merge_staging')
+		self.database.execute_sql('DROP TABLE IF EXISTS temp.merge_before')
+		self.database.execute_sql(
+			'CREATE TEMP TABLE merge_staging AS SELECT {} FROM {} WHERE 0'.format(
+				self.names, self.table))
+		self.database.execute_sql(
+			'CREATE TEMP TABLE merge_before (key TEXT PRIMARY KEY, segment TEXT, '
+			'email_hash TEXT)')
+		self._write = _block_writer(self.database, 'merge_staging', self.columns)
+
+	def block(self, block):
+		""" Stage a block, keep the first-seen state of its keys and
+		write its last record per key into the table.
+		"""
+		with metrics.timer('db_batch_seconds', table=self.table):
+			self.database.execute_sql('DELETE FROM temp.merge_staging')
+			self._write(block)
+			self.database.execute_sql(
+				'INSERT OR IGNORE INTO temp.merge_before '
+				'SELECT s.key, t.segment, t.email_hash '
+				'FROM (SELECT DISTINCT "{key}" AS key FROM temp.merge_staging) s '
+				'LEFT JOIN {table} t ON t."{key}" = s.key'.format(
+					key=self.key, table=self.table))
+			self.database.execute_sql(
+				'INSERT OR REPLACE INTO {table} ({names}) SELECT {names} '
+				'FROM temp.merge_staging WHERE rowid IN '
+				'(SELECT MAX(rowid) FROM temp.merge_staging GROUP BY "{key}")'.format(
+					table=self.table, names=self.names, key=self.key))
+		metrics.count('rows_imported', len(block))
+
+	def changes(self):
+		""" Adds and removes per segment for the keys merged so far.
+		"""
+		changes = {segment: {'add': [], 'remove': []} for segment in tiers.names}
+		query = ('SELECT {side}.segment, {side}.email_hash FROM temp.merge_before b '
+				 'JOIN {table} t ON t."{key}" = b.key '
+				 'WHERE {side}.email_hash IS NOT NULL AND '
+				 '(b.segment IS NOT t.segment OR b.email_hash IS NOT t.email_hash)')
+		for action, side in (('add', 't'), ('remove', 'b')):
+			rows = self.database.execute_sql(
+				query.format(side=side, table=self.table, key=self.key))
+			for segment, email_hash in rows:
+				if segment in changes:
+					changes[segment][action].append(email_hash)
+
+		return changes
+
+	def end(self):
+		self.database.execute_sql('DROP TABLE temp.merge_staging')
+		self.database.execute_sql('DROP TABLE temp.merge_before')
+
+
+def _insert_statement(table, columns, rows):
+	""" An INSERT OR REPLACE statement for `rows` rows of `columns`.
+
+	:params table: str, name of table
+	:params columns: list, column names
+	:params rows: int, rows of placeholders
+
+	return :: str, SQL
+	"""
+	row = '({})'.format(', '.join('?' * len(columns)))
+
+	return 'INSERT OR REPLACE INTO "{}" ({}) VALUES {}'.format(
+		table, ', '.join('"{}"'.format(column) for column in columns),
+		', '.join([row] * rows))
+
+
+def max_variables(database):
+	""" The SQLITE_MAX_VARIABLE_NUMBER of a connection. Read with
+	getlimit (Python 3.11+), else from the compile options, else the
+	default of the SQLite version (999 before 3.32, 32766 after).
+
+	:params database: peewee.SqliteDatabase
+
+	return :: int
+	"""
+	conn = database.get_conn()
+	if hasattr(conn, 'getlimit'):
+		return conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+	for option, in database.execute_sql('PRAGMA compile_options').fetchall():
+		if option.startswith('MAX_VARIABLE_NUMBER='):
+			return int(option.split('=', 1)[1])
+
+	return 999 if sqlite3.sqlite_version_info < (3, 32, 0) else 32766
+
+
+@contextmanager
+def bulk_pragmas(database):
+	""" Apply BULK_PRAGMAS for the block and restore the previous
+	settings after it. WAL with synchronous=NORMAL stays crash-safe
+	for the database file; a power loss can only roll back the
+	newest transactions.
+
+	:params database: peewee.SqliteDatabase
+	"""
+	previous = [(name, database.execute_sql('PRAGMA {}'.format(name)).fetchone()[0])
+				for name, value in BULK_PRAGMAS]
+	for name, value in BULK_PRAGMAS:
+		database.execute_sql('PRAGMA {} = {}'.format(name, value))
+	try:
+		yield
+	finally:
+		for name, value in reversed(previous):
+			database.execute_sql('PRAGMA {} = {}'.format(name, value))
+
+
+def hash_email(email):
+	""" Normalize and SHA-256 hash an email the way the Graph API
+	expects for the EMAIL_SHA256 schema.
+
+	:params email: str, raw email
+
+	return :: str, hex digest (None for a missing email)
+	"""
+	if email is None:
+		return None
+
+	return hashlib.sha256(
+		email.strip(" \t\r\n\0\x0B.").lower().encode('utf8')).hexdigest()
+
+
+def hash_records(records, pool=None):
+	""" Set 'email_hash' on a block of records from 'usa_email'.
+
+	:params records: list, list of dictionaries
+	:params pool: multiprocessing.Pool, optional pool to hash on
+
+	return :: list, the same records
+	"""
+	emails = [record.get('usa_email') for record in records]
+	if pool:
+		chunksize = max(1, len(emails) // (4 * pool._processes))
+		hashes = pool.map(hash_email, emails, chunksize)
+	else:
+		hashes = map(hash_email, emails)
+
+	for record, email_hash in zip(records, hashes):
+		record['email_hash'] = email_hash
+
+	return records
 
 
 def sqlite_truncate(table):
@@ -186,16 +1095,18 @@ def sqlite_truncate(table):
 
 
 def data_generator(data, size=90):
-	""" A generator that chunks large sets of data.
+	""" A generator that chunks large sets of data. Works on
+	lists and on lazy iterables alike; only one chunk is held
+	at a time.
 
-	:params data: list, list of dictionaries containing records
+	:params data: iterable, list or generator of dictionaries containing records
 	:params size: integer, number of records per chunk
 	"""
-	for step in range(0, len(data), size):
-		try:
-			yield data[step:step + size]
-		except IndexError:
-			yield data[step:len(data)]
+	records = iter(data)
+	chunk = list(itertools.islice(records, size))
+	while chunk:
+		yield chunk
+		chunk = list(itertools.islice(records, size))
 
 
 
@@ -0,0 +1,3 @@
+"""
+benchmarks -- offline load tests for the audience pipeline
+"""
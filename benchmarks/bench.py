@@ -0,0 +1,250 @@
+"""
+bench -- offline benchmark of the build, execute and rebuild flows
+
+Generates synthetic customer files, serves them from a local FTP
+server, points the SDK at a stub Graph API and runs the run.py flows
+against a scratch database, timing every stage.
+
+Needs Python 3.6 or later, as the package itself.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench --rows 100000
+    python -m benchmarks.bench --rows 1000000 --memory
+    python -m benchmarks.bench --rows 10000000 --phases build,execute --json out.json
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import functools
+import tracemalloc
+
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import run
+
+from audience import config, models, pipeline, Sorter, Adapter
+from facebookads.session import FacebookSession
+from benchmarks import synthetic
+from benchmarks.ftpserver import FTPServer
+from benchmarks.graphapi import GraphServer
+
+# (owner, attribute, stage) -- callables timed as pipeline stages.
+STAGES = (
+    (run, 'write_database', 'write_database'),
+    (run, 'stream_source', 'stream_source'),
+    (run, 'sqlite_import', 'sqlite_import'),
+    (run, 'sqlite_merge', 'sqlite_import'),
+    (pipeline, 'merge_block', 'merge_block'),
+    (run, 'record_ingested', 'record_ingested'),
+    (Sorter, '_generate_pushes', 'sorter'),
+    (Sorter, '_generate_deletes', 'sorter'),
+    (Adapter, 'create_audience', 'audiences'),
+    (Adapter, 'delete_audience', 'audiences'),
+    (Adapter, 'upload', 'upload'),
+    (Adapter, 'send', 'upload'),
+    (Adapter, 'sync', 'upload'),
+)
+
+PHASES = ('build', 'execute', 'sync', 'pipeline', 'rebuild')
+
+
+class Recorder:
+    """ Collects wall time, call counts, imported rows and (optionally)
+    the tracemalloc peak of every stage, per phase. A stage called from
+    inside itself (sync -> upload) is only timed once.
+
+    :params memory: boolean, trace Python allocations
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.phase = None
+        self.stages = OrderedDict()
+        self.phases = OrderedDict()
+        self._active = set()
+
+    def wrap(self, owner, attribute, stage):
+        """ Replace owner.attribute with a timed version.
+        """
+        original = getattr(owner, attribute)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            if stage in self._active:
+                return original(*args, **kwargs)
+            if stage == 'sqlite_import':
+                args = (args[0], self.count(args[1])) + args[2:]
+            self._active.add(stage)
+            if self.memory:
+                _reset_peak()
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._active.discard(stage)
+                self.record(stage, time.perf_counter() - start)
+
+        setattr(owner, attribute, timed)
+
+    def count(self, records):
+        """ Pass records through, counting them into the phase.
+        """
+        for record in records:
+            self.phases[self.phase]['rows'] += 1
+            yield record
+
+    def record(self, stage, seconds):
+        entry = self.stages.setdefault((self.phase, stage), {
+            'phase': self.phase, 'stage': stage, 'seconds': 0.0,
+            'calls': 0, 'peak_mb': 0.0})
+        entry['seconds'] += seconds
+        entry['calls'] += 1
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            entry['peak_mb'] = max(entry['peak_mb'], peak)
+
+    def run_phase(self, phase, flow):
+        """ Run one flow as a named phase.
+        """
+        self.phase = phase
+        self.phases[phase] = {'phase': phase, 'rows': 0}
+        start = time.perf_counter()
+        flow()
+        self.phases[phase].update(
+            seconds=time.perf_counter() - start,
+            max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _reset_peak():
+    """ Start a new tracemalloc peak. Before Python 3.9 the traces
+    are cleared instead, which also resets the peak.
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.clear_traces()
+
+
+def configure(workdir, ftp, graph):
+    """ Point config, the database and the SDK at the scratch setup.
+    """
+    config.DATABASE_PATH = os.path.join(workdir, 'customers.db')
+    models.database.init(config.DATABASE_PATH)
+    config.FTP_HOST, config.FTP_PORT = '127.0.0.1', ftp.port
+    config.FTP_USER = config.FTP_PASSWORD = 'bench'
+    config.FTP_DIR = '/'
+    config.SITE_ID = '1'
+    config.CURRENT, config.LAPSED, config.EXTRA = 'Current', 'Lapsed', 'Extra Lapsed'
+    config.DEBUG = False
+    FacebookSession.GRAPH = graph.url
+
+
+def close_database():
+    """ Close this thread's connection so teardown removes a closed file.
+    """
+    if not models.database.is_closed():
+        models.database.close()
+
+
+def report(recorder, graph, out=sys.stdout):
+    """ Print the per-stage table and the API call counts. Rates are
+    rows imported in the phase over the stage's time.
+    """
+    out.write('\n{:<10} {:<16} {:>10} {:>7} {:>12} {:>9}\n'.format(
+        'phase', 'stage', 'seconds', 'calls', 'rows/s', 'peak MB'))
+    for entry in recorder.stages.values():
+        rows = recorder.phases[entry['phase']]['rows']
+        rate = rows / entry['seconds'] if entry['stage'] in (
+            'stream_source', 'sqlite_import') and entry['seconds'] else 0
+        out.write('{phase:<10} {stage:<16} {seconds:>10.3f} {calls:>7} '.format(**entry) +
+                  '{:>12,.0f} {:>9.1f}\n'.format(rate, entry['peak_mb']))
+    for phase in recorder.phases.values():
+        out.write('{:<10} {:<16} {:>10.3f}   {:,} rows, max rss {:.0f} MB\n'.format(
+            phase['phase'], 'total', phase['seconds'], phase['rows'],
+            phase['max_rss_mb']))
+    out.write('\napi calls: {}\n'.format(dict(graph.state.calls)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the audience pipeline offline')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='customers to generate (100000, 1000000, 10000000)')
+    parser.add_argument('--files', type=int, default=4, help='weekly csv files')
+    parser.add_argument('--xlsx-share', type=float, default=0.1,
+                        help='share of customers in the legacy workbook')
+    parser.add_argument('--churn', type=float, default=0.02,
+                        help='new weekly file size as a share of rows')
+    parser.add_argument('--phases', default='build,execute,rebuild',
+                        help='comma separated, from: ' + ','.join(PHASES))
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds the stub adds to every users call')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace allocations (slows the run down)')
+    parser.add_argument('--workdir', help='keep files here instead of a temp dir')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='audience-bench-')
+    served = os.path.join(workdir, 'ftp')
+    if not os.path.isdir(served):
+        print('Generating {:,} customers in {}'.format(args.rows, served))
+        synthetic.generate(served, args.rows, args.files, args.xlsx_share)
+
+    ftp = FTPServer(served).start()
+    graph = GraphServer(args.api_latency).start()
+    configure(workdir, ftp, graph)
+
+    recorder = Recorder(args.memory)
+    for owner, attribute, stage in STAGES:
+        recorder.wrap(owner, attribute, stage)
+    if args.memory:
+        tracemalloc.start()
+
+    week = [date.today()]
+
+    def new_week():
+        week[0] += timedelta(weeks=1)
+        synthetic.add_week(served, args.rows, int(args.rows * args.churn),
+                           week[0], seed=week[0].toordinal())
+
+    def rebuild():
+        close_database()
+        run.teardown(config)
+        run.build(config)
+
+    flows = {'build': lambda: run.build(config),
+             'execute': lambda: (new_week(), run.execute(config)),
+             'sync': lambda: (new_week(), run.sync(config)),
+             'pipeline': lambda: (new_week(), run.pipeline(config)),
+             'rebuild': rebuild}
+
+    close_database()
+    if os.path.exists(config.DATABASE_PATH):
+        os.remove(config.DATABASE_PATH)
+    try:
+        for phase in args.phases.split(','):
+            recorder.run_phase(phase, flows[phase])
+    finally:
+        ftp.shutdown()
+        graph.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(recorder, graph)
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump({'rows': args.rows, 'phases': list(recorder.phases.values()),
+                       'stages': list(recorder.stages.values()),
+                       'api_calls': dict(graph.state.calls)}, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
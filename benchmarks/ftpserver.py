@@ -0,0 +1,150 @@
+"""
+ftpserver -- a minimal local FTP server over a directory
+
+Implements the commands ftplib issues for stream_ftp (login, CWD,
+PASV/EPSV, NLST, RETR, SIZE, MDTM) and nothing more. Read-only and
+for benchmarking only: any user name and password are accepted.
+"""
+import os
+import time
+import socket
+import threading
+import socketserver
+
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """ One control connection. Data connections are passive only.
+    """
+
+    def setup(self):
+        super().setup()
+        self.cwd = '/'
+        self.passive = None
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf8'))
+
+    def handle(self):
+        self.reply('220 benchmark ftp ready')
+        for raw in self.rfile:
+            line = raw.decode('utf8').rstrip('\r\n')
+            command, _, argument = line.partition(' ')
+            handler = getattr(self, 'ftp_' + command.upper(), None)
+            if handler is None:
+                self.reply('502 Command not implemented')
+                continue
+            if handler(argument) is False:
+                break
+
+    def path(self, name):
+        """ Resolve a client path inside the served root.
+        """
+        joined = os.path.normpath(os.path.join(self.cwd, name or '.'))
+        return os.path.join(self.server.root, joined.lstrip('/'))
+
+    def ftp_USER(self, argument):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, argument):
+        self.reply('230 Logged in')
+
+    def ftp_TYPE(self, argument):
+        self.reply('200 Type set')
+
+    def ftp_NOOP(self, argument):
+        self.reply('200 OK')
+
+    def ftp_PWD(self, argument):
+        self.reply('257 "{}"'.format(self.cwd))
+
+    def ftp_CWD(self, argument):
+        if not os.path.isdir(self.path(argument)):
+            return self.reply('550 No such directory')
+        self.cwd = os.path.normpath(os.path.join(self.cwd, argument))
+        self.reply('250 OK')
+
+    def ftp_PASV(self, argument):
+        self.passive = socket.socket()
+        self.passive.bind((self.server.server_address[0], 0))
+        self.passive.listen(1)
+        host, port = self.passive.getsockname()
+        self.reply('227 Entering Passive Mode ({},{},{})'.format(
+            host.replace('.', ','), port >> 8, port & 0xFF))
+
+    def ftp_EPSV(self, argument):
+        self.passive = socket.socket()
+        self.passive.bind((self.server.server_address[0], 0))
+        self.passive.listen(1)
+        self.reply('229 Entering Extended Passive Mode (|||{}|)'.format(
+            self.passive.getsockname()[1]))
+
+    def ftp_NLST(self, argument):
+        names = sorted(os.listdir(self.path(argument)))
+        self.transfer(('\r\n'.join(names) + '\r\n').encode('utf8'))
+
+    def ftp_RETR(self, argument):
+        path = self.path(argument)
+        if not os.path.isfile(path):
+            return self.reply('550 No such file')
+        with open(path, 'rb') as handle:
+            self.transfer(handle)
+
+    def ftp_SIZE(self, argument):
+        path = self.path(argument)
+        if not os.path.isfile(path):
+            return self.reply('550 No such file')
+        self.reply('213 {}'.format(os.path.getsize(path)))
+
+    def ftp_MDTM(self, argument):
+        path = self.path(argument)
+        if not os.path.isfile(path):
+            return self.reply('550 No such file')
+        self.reply('213 {}'.format(time.strftime(
+            '%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(path)))))
+
+    def ftp_QUIT(self, argument):
+        self.reply('221 Bye')
+        return False
+
+    def transfer(self, payload):
+        """ Send bytes or a file over the pending passive connection.
+        """
+        if self.passive is None:
+            return self.reply('425 Use PASV first')
+        self.reply('150 Opening data connection')
+        conn, _ = self.passive.accept()
+        try:
+            if isinstance(payload, bytes):
+                conn.sendall(payload)
+            else:
+                conn.sendfile(payload)
+        finally:
+            conn.close()
+            self.passive.close()
+            self.passive = None
+        self.reply('226 Transfer complete')
+
+
+class FTPServer(socketserver.ThreadingTCPServer):
+    """ Serve `root` read-only on host:port (port 0 picks a free one).
+
+    :params root: str, directory to serve
+    :params host: str, interface to bind
+    :params port: int, control port
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        self.root = os.path.abspath(root)
+        super().__init__((host, port), FTPHandler)
+
+    def start(self):
+        """ Serve on a daemon thread and return self.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
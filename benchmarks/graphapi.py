@@ -0,0 +1,172 @@
+"""
+graphapi -- a stub of the Graph API endpoints Adapter calls
+
+Keeps audiences and their members in memory, answers with usage
+headers like the real API, and counts calls per endpoint. Point the
+SDK at it with FacebookSession.GRAPH = server.url.
+"""
+import gzip
+import json
+import time
+import threading
+import urllib.parse
+
+from collections import Counter
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:  # Python < 3.7
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    """ Routes /<version>/<path> and the batch endpoint to GraphState.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            params.update(urllib.parse.parse_qsl(body.decode('utf8')))
+        parts = [part for part in url.path.split('/')[2:] if part]
+
+        if not parts and method == 'POST' and 'batch' in params:
+            status, body = 200, self.server.state.batch(json.loads(params['batch']))
+        else:
+            status, body = self.server.state.call(method, parts, params)
+        self.respond(status, body)
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('x-app-usage', json.dumps(self.server.state.usage()))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class GraphState:
+    """ In-memory audiences and call accounting.
+
+    :params latency: float, seconds added to every users call
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.audiences = {}
+        self.members = {}
+        self.calls = Counter()
+        self._next_id = 1000
+        self._lock = threading.Lock()
+
+    def call(self, method, parts, params):
+        """ Answer one API call.
+
+        :params method: str, HTTP method
+        :params parts: list, path tokens after the version
+        :params params: dict, query and form parameters
+
+        return :: tuple, (http status, json body)
+        """
+        endpoint = parts[-1] if parts[-1] in ('users', 'customaudiences') else 'node'
+        with self._lock:
+            self.calls['{} {}'.format(method, endpoint)] += 1
+
+        if endpoint == 'customaudiences' and method == 'GET':
+            with self._lock:
+                data = [{'id': key, 'name': name}
+                        for key, name in self.audiences.items()]
+            return 200, {'data': data}
+        if endpoint == 'customaudiences' and method == 'POST':
+            with self._lock:
+                self._next_id += 1
+                key = str(self._next_id)
+                self.audiences[key] = params.get('name')
+                self.members[key] = set()
+            return 200, {'id': key}
+        if endpoint == 'node' and method == 'DELETE':
+            with self._lock:
+                self.audiences.pop(parts[0], None)
+                self.members.pop(parts[0], None)
+            return 200, {'success': True}
+        if endpoint == 'users' and parts[0] in self.members:
+            time.sleep(self.latency)
+            data = json.loads(params['payload'])['data']
+            with self._lock:
+                if method == 'POST':
+                    self.members[parts[0]].update(data)
+                else:
+                    self.members[parts[0]].difference_update(data)
+            return 200, {'audience_id': parts[0], 'num_received': len(data),
+                         'num_invalid_entries': 0}
+
+        return 404, {'error': {'code': 100, 'message': 'Unknown path'}}
+
+    def batch(self, requests):
+        """ Answer a batch request, one entry per call.
+
+        :params requests: list, batch call descriptions
+        """
+        responses = []
+        for request in requests:
+            url = urllib.parse.urlparse(request['relative_url'])
+            params = dict(urllib.parse.parse_qsl(url.query))
+            params.update(urllib.parse.parse_qsl(request.get('body', '')))
+            parts = [part for part in url.path.split('/') if part]
+            if parts and parts[0].startswith('v') and '.' in parts[0]:
+                parts = parts[1:]
+            status, body = self.call(request['method'], parts, params)
+            responses.append({'code': status, 'headers': [],
+                              'body': json.dumps(body)})
+        with self._lock:
+            self.calls['POST batch'] += 1
+
+        return responses
+
+    def usage(self):
+        return {'call_count': 1, 'total_cputime': 1, 'total_time': 1}
+
+
+class GraphServer(ThreadingHTTPServer):
+    """ Serve a GraphState on host:port (port 0 picks a free one).
+
+    :params latency: float, seconds added to every users call
+    :params host: str, interface to bind
+    :params port: int, port
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0):
+        self.state = GraphState(latency)
+        super().__init__((host, port), GraphHandler)
+
+    def start(self):
+        """ Serve on a daemon thread and return self.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
@@ -0,0 +1,150 @@
+"""
+synthetic -- customer files shaped like the vendor's FTP drops
+
+CSV files carry the headers process_csv_bytestring expects (dates as
+mm/dd/YYYY, address columns included); XLSX files carry the headers
+process_xlsx_bytestring expects on 'Sheet1' (dates as datetimes).
+"""
+import os
+import csv
+import random
+
+from datetime import date, datetime, timedelta
+from openpyxl import Workbook
+
+CSV_HEADERS = ['Sell-to Customer No_', 'Last Order Date', 'Phone No_',
+               'Current Med Advantage', 'Sell-to Customer Name',
+               'Ship-to Post Code', 'USA Email', 'Total Number of Orders',
+               'Address 1', 'Address 2', 'City', 'State', 'Post Code',
+               'Country']
+XLSX_HEADERS = CSV_HEADERS[:8]
+
+
+def customer(number, rand, today=None):
+    """ Build one customer row. Order dates spread over four years so
+    every segment is populated.
+
+    :params number: int, customer number
+    :params rand: random.Random, seeded source
+    :params today: datetime.date, reference date
+
+    return :: list, values in CSV_HEADERS order
+    """
+    today = today or date.today()
+    ordered = today - timedelta(days=rand.randint(1, 1460))
+
+    return ['C{:09d}'.format(number), ordered, '555{:07d}'.format(number),
+            rand.choice(('Y', 'N')), 'Customer, {}'.format(number),
+            '{:05d}'.format(rand.randint(0, 99999)),
+            'Customer.{}@Example.com'.format(number),
+            str(rand.randint(1, 40)), '{} Main St'.format(number), '',
+            'Springfield', 'IL', '62701', 'US']
+
+
+def write_csv(path, numbers, seed=0):
+    """ Write a weekly CSV file for the given customer numbers.
+
+    :params path: str, file to write
+    :params numbers: iterable, customer numbers
+    :params seed: int, random seed
+
+    return :: int, rows written
+    """
+    rand = random.Random(seed)
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8-sig') as handle:
+        writer = csv.writer(handle, lineterminator='\r\n')
+        writer.writerow(CSV_HEADERS)
+        for number in numbers:
+            row = customer(number, rand)
+            row[1] = row[1].strftime('%m/%d/%Y')
+            writer.writerow(row)
+            rows += 1
+
+    return rows
+
+
+def write_xlsx(path, numbers, seed=0):
+    """ Write a legacy vendor workbook for the given customer numbers.
+
+    :params path: str, file to write
+    :params numbers: iterable, customer numbers
+    :params seed: int, random seed
+
+    return :: int, rows written
+    """
+    rand = random.Random(seed)
+    rows = 0
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append(XLSX_HEADERS)
+    for number in numbers:
+        row = customer(number, rand)[:8]
+        row[1] = datetime.combine(row[1], datetime.min.time())
+        ws.append(row)
+        rows += 1
+    wb.save(path)
+
+    return rows
+
+
+def generate(directory, rows, files=4, xlsx_share=0.1, start=None, seed=0):
+    """ Fill a directory with one legacy workbook and `files` weekly
+    CSV files holding `rows` customers between them.
+
+    :params directory: str, target directory
+    :params rows: int, total customers
+    :params files: int, number of weekly CSV files
+    :params xlsx_share: float, share of customers in the workbook
+    :params start: datetime.date, date of the first weekly file
+    :params seed: int, random seed
+
+    return :: list of file names, in import order
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = start or date.today() - timedelta(weeks=files + 1)
+    legacy = int(rows * xlsx_share)
+    names = []
+
+    if legacy:
+        names.append('vendor-000001.xlsx')
+        write_xlsx(os.path.join(directory, names[-1]), range(legacy), seed)
+
+    weekly = rows - legacy
+    for index in range(files):
+        first = legacy + index * weekly // files
+        last = legacy + (index + 1) * weekly // files
+        names.append(weekly_name(start + timedelta(weeks=index)))
+        write_csv(os.path.join(directory, names[-1]), range(first, last),
+                  seed + index + 1)
+
+    return names
+
+
+def add_week(directory, rows, new, when, seed=0):
+    """ Drop the next weekly file: `new` unseen customers plus
+    returning customers drawn from the first `rows`.
+
+    :params directory: str, target directory
+    :params rows: int, customers generated so far
+    :params new: int, customers in the new file
+    :params when: datetime.date, date of the file
+    :params seed: int, random seed
+
+    return :: str, file name
+    """
+    rand = random.Random(seed)
+    returning = rand.sample(range(rows), min(rows, new // 2))
+    name = weekly_name(when)
+    write_csv(os.path.join(directory, name),
+              returning + list(range(rows, rows + new - len(returning))), seed)
+
+    return name
+
+
+def weekly_name(when):
+    """ The FTP naming scheme for weekly files.
+
+    :params when: datetime.date, file date
+    """
+    return 'vendor_{}.csv'.format(when.strftime('%Y%m%d'))
@@ -18,16 +18,61 @@ Usage:
     Tear down the database and delete audiences:
     
      python run.py teardown 
+    
+    Run the on-going process, uploading only membership changes:
+    
+     python run.py sync 
+    
+    Finish the uploads of a run that failed partway through:
+    
+     python run.py resume 
+    
+    Run the on-going process with download, load and upload overlapped:
+    
+     python run.py pipeline 
+    
+    Run an action for many clients in parallel on a pool of processes:
+    
+     python run.py execute --clients clients/*.py --processes 8 
 
 """
 import sys
 import os
+import time
 import argparse
+import traceback
+import contextlib
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from audience import config, models
 from audience import Sorter, Adapter
-from audience import (stream_ftp, sqlite_import,
-                      sqlite_truncate, write_database)
+from audience import (stream_source, source_for, sqlite_import, sqlite_merge,
+                      record_ingested, sqlite_truncate, write_database)
+from audience.metrics import metrics, profiled
+from audience.pipeline import run_pipeline
+
+
+def audiences(config):
+    """ The audiences to manage, one per segment: config.AUDIENCES,
+    or CURRENT, LAPSED and EXTRA for the three tiers of
+    config.SEGMENTS, most recent first. In DEBUG the names get the
+    ' test' suffix.
+
+    :params config: module, configuration
+
+    return :: list of (audience name, segment) tuples
+    """
+    pairs = config.AUDIENCES
+    if not pairs:
+        if len(config.SEGMENTS) != 3:
+            raise ValueError('config.AUDIENCES must name an audience for each '
+                             'of the {} SEGMENTS'.format(len(config.SEGMENTS)))
+        pairs = zip((config.CURRENT, config.LAPSED, config.EXTRA), config.SEGMENTS)
+    if config.DEBUG:
+        return [(name+' test', segment) for name, segment in pairs]
+
+    return list(pairs)
 
 
 def build(config):
@@ -36,33 +81,59 @@ def build(config):
 
     :params config: module, configuration
     """
-    write_database(config)
-    data = stream_ftp(config)
-    sqlite_import('customers', data)
+    with metrics.stage('ingest'):
+        write_database(config)
+        ledger = []
+        data = stream_source(source_for(config), stream=config.FTP_STREAM,
+                             workers=config.FTP_WORKERS, ledger=ledger,
+                             processes=config.PARSE_PROCESSES)
+        sqlite_import('customers', data, processes=config.HASH_PROCESSES,
+                      bulk=config.BULK_LOAD)
+        record_ingested(ledger)
 
-    prepared = Sorter()
-    prepared.add_sort
+    with metrics.stage('sort'):
+        prepared = Sorter(stream=True)
+        prepared.add_sort
 
     if config.DEBUG:
-        adapter = Adapter(config.TESTING_SITE_ID)
-        # Create audiences
-        adapter.create_audience(config.CURRENT+' test')
-        adapter.create_audience(config.LAPSED+' test')
-        adapter.create_audience(config.EXTRA+' test')
-        # Add users 
-        adapter.add_users(config.CURRENT+' test', prepared.current)
-        adapter.add_users(config.LAPSED+' test', prepared.lapsed)
-        adapter.add_users(config.EXTRA+' test', prepared.extra_lapsed)
+        adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
     else:
-        adapter = Adapter(config.SITE_ID)
-        # Create audiences
-        adapter.create_audience(config.CURRENT)
-        adapter.create_audience(config.LAPSED)
-        adapter.create_audience(config.EXTRA)
-        # Add users 
-        adapter.add_users(config.CURRENT, prepared.current)
-        adapter.add_users(config.LAPSED, prepared.lapsed)
-        adapter.add_users(config.EXTRA, prepared.extra_lapsed)
+        adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
+    # Create audiences
+    for name, segment in audiences(config):
+        adapter.create_audience(name)
+    # Add users 
+    adapter.upload([('add', name, prepared.adds(segment))
+                    for name, segment in audiences(config)])
+
+
+def _ingest_and_sort(config):
+    """ The shared start of execute and sync: import the new files
+    and move customers between segments.
+
+    :params config: module, configuration
+
+    return :: audience.Sorter, with the adds and removes of the run
+    """
+    with metrics.stage('ingest'):
+        write_database(config)
+        ledger = []
+        data = stream_source(source_for(config), keyword='_',
+                             stream=config.FTP_STREAM, workers=config.FTP_WORKERS,
+                             ledger=ledger, processes=config.PARSE_PROCESSES)
+        changes = None
+        if config.MERGE_IMPORT:
+            changes = sqlite_merge('customers', data, processes=config.HASH_PROCESSES)
+        else:
+            sqlite_import('customers', data, processes=config.HASH_PROCESSES,
+                          bulk=config.BULK_LOAD)
+        record_ingested(ledger)
+
+    with metrics.stage('sort'):
+        prepared = Sorter(changes=changes, stream=True)
+        prepared.add_remove_sort
+
+    return prepared
 
 
 def execute(config):
@@ -71,32 +142,70 @@ def execute(config):
 
     :params config: module, configuration
     """
-    data = stream_ftp(config, keyword='_')
-    sqlite_import('customers', data)
+    prepared = _ingest_and_sort(config)
+
+    if config.DEBUG:
+        adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
+    else:
+        adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
+    # Remove users, then add users
+    adapter.upload([('remove', name, prepared.removes(segment))
+                    for name, segment in audiences(config)] +
+                   [('add', name, prepared.adds(segment))
+                    for name, segment in audiences(config)])
+
+
+def sync(config):
+    """ The on-going flow in differential mode. New files are
+    processed and segments moved as in execute, then each audience
+    gets only the difference between its segment and the membership
+    recorded from earlier uploads.
+
+    :params config: module, configuration
+    """
+    _ingest_and_sort(config)
+
+    if config.DEBUG:
+        adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
+    else:
+        adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
+    adapter.sync(audiences(config))
+
+
+def pipeline(config):
+    """ The on-going flow of execute, with new files merged block by
+    block and every block's audience changes uploaded while the next
+    ones download and load.
+
+    :params config: module, configuration
+    """
+    with metrics.stage('pipeline'):
+        write_database(config)
+        ledger = []
+
+        if config.DEBUG:
+            adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
+        else:
+            adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
+        blocks = run_pipeline(config, adapter, audiences(config), ledger=ledger)
+        record_ingested(ledger)
+    print('Pipeline merged {} blocks.'.format(blocks))
+
 
-    prepared = Sorter()
-    prepared.add_remove_sort
+def resume(config):
+    """ Send the journaled upload batches of an earlier run that
+    were never acknowledged.
+
+    :params config: module, configuration
+    """
+    write_database(config)
 
     if config.DEBUG:
-        adapter = Adapter(config.TESTING_SITE_ID)
-        # Remove users
-        adapter.remove_users(config.CURRENT+' test', prepared.current_deletes)
-        adapter.remove_users(config.LAPSED+' test', prepared.lapsed_deletes)
-        adapter.remove_users(config.EXTRA+' test', prepared.extra_lapsed_deletes)
-        # Add users
-        adapter.add_users(config.CURRENT+' test', prepared.current)
-        adapter.add_users(config.LAPSED+' test', prepared.lapsed)
-        adapter.add_users(config.EXTRA+' test', prepared.extra_lapsed)
+        adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
     else:
-        adapter = Adapter(config.SITE_ID)
-        # Remove users
-        adapter.remove_users(config.CURRENT, prepared.current_deletes)
-        adapter.remove_users(config.LAPSED, prepared.lapsed_deletes)
-        adapter.remove_users(config.EXTRA, prepared.extra_lapsed_deletes)
-        # Add users
-        adapter.add_users(config.CURRENT, prepared.current)
-        adapter.add_users(config.LAPSED, prepared.lapsed)
-        adapter.add_users(config.EXTRA, prepared.extra_lapsed)
+        adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
+    sent = adapter.resume()
+    print('Resumed {} batches.'.format(sent))
 
 
 def teardown(config):
@@ -104,39 +213,127 @@ def teardown(config):
     
     :params config: module, configuration
     """
-    try:
-        os.remove(config.DATABASE_PATH)
-    except FileNotFoundError:
-        print('Attempted db file removal. No db file to remove.')
+    with metrics.stage('teardown'):
+        models.use(config.DATABASE_PATH)
+        try:
+            os.remove(config.DATABASE_PATH)
+        except FileNotFoundError:
+            print('Attempted db file removal. No db file to remove.')
 
-    if config.DEBUG:
-        adapter = Adapter(config.TESTING_SITE_ID)
-        # Delete audiences
-        adapter.delete_audience(config.CURRENT+' test')
-        adapter.delete_audience(config.LAPSED+' test')
-        adapter.delete_audience(config.EXTRA+' test')
-    else:
-        adapter = Adapter(config.SITE_ID)
+        if config.DEBUG:
+            adapter = Adapter(config.TESTING_SITE_ID, pre_hashed=True, settings=config)
+        else:
+            adapter = Adapter(config.SITE_ID, pre_hashed=True, settings=config)
         # Delete audiences
-        adapter.delete_audience(config.CURRENT)
-        adapter.delete_audience(config.LAPSED)
-        adapter.delete_audience(config.EXTRA)
+        for name, segment in audiences(config):
+            adapter.delete_audience(name)
 
 
-if __name__ == '__main__':
+def run_action(action, config):
+    """ Run one action against a configuration.
 
-    parser = argparse.ArgumentParser(description='Run the Audience Management Process')
-    parser.add_argument("action", help="build|teardown|execute|rebuild")
-    args = parser.parse_args()
-
-    if args.action == 'build':
+    :params action: str, build|teardown|execute|rebuild|sync|resume|pipeline
+    :params config: module, configuration
+    """
+    if action == 'build':
         build(config)
-    if args.action == 'teardown':
+    if action == 'teardown':
         teardown(config)
-    if args.action == 'execute':
+    if action == 'execute':
         execute(config)
-    if args.action == 'rebuild':
+    if action == 'sync':
+        sync(config)
+    if action == 'resume':
+        resume(config)
+    if action == 'pipeline':
+        pipeline(config)
+    if action == 'rebuild':
         teardown(config)
         build(config)
-    
-        
\ No newline at end of file
+
+
+def run_client(action, path):
+    """ Run one action for a client configuration file. Runs in a
+    scheduler process: the database, metrics and Graph API session
+    (and so the rate-limit budget) all belong to this client.
+
+    :params action: str, action name
+    :params path: str, client configuration file
+
+    return :: tuple, (path, seconds, error traceback or None)
+    """
+    client = config.load(path)
+    models.use(client.DATABASE_PATH)
+    metrics.configure(client.METRICS_PATH)
+    start = time.time()
+    try:
+        run_action(action, client)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        metrics.flush()
+
+    return path, time.time() - start, error
+
+
+def schedule(action, paths, processes=None):
+    """ Run an action for many client configuration files in parallel
+    on a pool of processes. A failing client does not stop the others.
+
+    :params action: str, action name
+    :params paths: list, client configuration files
+    :params processes: int, concurrent clients; None = one per CPU
+
+    return :: list of (path, seconds, error) tuples, in completion order
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(run_client, action, path) for path in paths]
+        for future in as_completed(futures):
+            path, seconds, error = future.result()
+            print('{} {} in {:.1f}s{}'.format(
+                path, 'failed' if error else 'done', seconds,
+                ':\n' + error if error else ''))
+            results.append((path, seconds, error))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the Audience Management Process')
+    parser.add_argument("action", help="build|teardown|execute|rebuild|sync|resume|pipeline")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="append stage timings and counters as JSON lines to FILE")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="PATH",
+                        help="profile the run, writing PATH.pstats and PATH.txt")
+    parser.add_argument("--source-dir", metavar="DIR",
+                        help="read the customer files from DIR instead of the FTP server")
+    parser.add_argument("--clients", nargs="+", metavar="FILE",
+                        help="client configuration files to run the action for, in parallel; "
+                             "each sets its own SOURCE and METRICS_PATH")
+    parser.add_argument("--processes", type=int,
+                        help="clients run at once with --clients (default: one per CPU)")
+    args = parser.parse_args()
+
+    if args.clients:
+        for option, value in (('--source-dir', args.source_dir),
+                              ('--metrics', args.metrics),
+                              ('--profile', args.profile)):
+            if value:
+                parser.error('{} cannot be combined with --clients'.format(option))
+        results = schedule(args.action, args.clients, args.processes)
+        sys.exit(1 if any(error for path, seconds, error in results) else 0)
+
+    if args.source_dir:
+        config.SOURCE, config.SOURCE_DIR = 'local', args.source_dir
+    if args.metrics:
+        config.METRICS_PATH = args.metrics
+    metrics.configure(config.METRICS_PATH)
+    profile = profiled(args.profile) if args.profile else contextlib.ExitStack()
+
+    with profile:
+        run_action(args.action, config)
+
+    metrics.flush()
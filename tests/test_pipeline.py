@@ -0,0 +1,94 @@
+"""
+test_pipeline -- run.py pipeline against the benchmark stubs
+
+Serves synthetic files from a local FTP server and answers the SDK
+from the stub Graph API, as benchmarks.bench does.
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import date, timedelta
+from unittest import mock
+
+import run
+
+from audience import config, models, pipeline
+from audience.utils import tiers
+from benchmarks import bench, synthetic
+from benchmarks.ftpserver import FTPServer
+from benchmarks.graphapi import GraphServer
+
+ROWS = 4000
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='audience-test-')
+        self.served = os.path.join(self.workdir, 'ftp')
+        synthetic.generate(self.served, ROWS, files=2)
+        self.ftp = FTPServer(self.served).start()
+        self.graph = GraphServer().start()
+        settings = {name: getattr(config, name) for name in dir(config)
+                    if name.isupper()}
+        self.addCleanup(lambda: [setattr(config, name, value)
+                                 for name, value in settings.items()])
+        bench.configure(self.workdir, self.ftp, self.graph)
+        config.PIPELINE_QUEUE = 1
+
+    def tearDown(self):
+        bench.close_database()
+        for server in (self.ftp, self.graph):
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def new_week(self, weeks):
+        synthetic.add_week(self.served, ROWS, ROWS // 4,
+                           date.today() + timedelta(weeks=weeks), seed=weeks)
+
+    def assert_audiences_match(self):
+        state = self.graph.state
+        names = {name: key for key, name in state.audiences.items()}
+        audiences = zip((config.CURRENT, config.LAPSED, config.EXTRA), tiers.names)
+        for name, segment in audiences:
+            held = {email_hash for email_hash, in models.database.execute_sql(
+                'SELECT email_hash FROM customers WHERE segment = ?', (segment,))}
+            self.assertEqual(state.members[names[name]], held, name)
+
+    def test_failed_run_is_resumed(self):
+        """ A run that fails on a users call loses none of the changes
+        it committed: resume() sends them and the next run the rest.
+        """
+        run.build(config)
+        self.new_week(1)
+
+        calls = {'users': 0}
+        answer = self.graph.state.call
+
+        def fail_third(method, parts, params):
+            if parts[-1] == 'users':
+                calls['users'] += 1
+                if calls['users'] == 3:
+                    return 400, {'error': {'code': 100, 'message': 'Invalid'}}
+            return answer(method, parts, params)
+
+        with mock.patch.object(self.graph.state, 'call', fail_third), \
+                mock.patch.object(pipeline, 'HASH_BLOCK', 200):
+            with self.assertRaises(Exception):
+                run.pipeline(config)
+        self.assertGreater(models.upload_journal.select().count(), 0)
+
+        run.resume(config)
+        run.pipeline(config)
+
+        self.assertEqual(models.upload_journal.select().count(), 0)
+        self.assert_audiences_match()
+
+
+if __name__ == '__main__':
+    unittest.main()